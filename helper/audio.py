@@ -1,12 +1,16 @@
 
+import asyncio
 import logging
-import queue
+import re
+import threading
+import time
 
 import numpy as np
 from pywhispercpp.constants import WHISPER_SAMPLE_RATE
 from pywhispercpp.model import Segment
-from typing import Callable
+from typing import AsyncIterator, Callable
 from setup import Registry
+from transcription import TranscriptionSession
 import sounddevice as sd
 logger = logging.getLogger(__name__)
 
@@ -22,90 +26,511 @@ class AudioConstants:
     CHANNELS = 1
     BLOCK_SIZE = int(SAMPLE_RATE * BLOCK_DURATION/1000)
 
+    # webrtcvad only takes 10, 20 or 30 ms frames of 16-bit PCM
+    VAD_FRAME_DURATION = 30
+    VAD_FRAME_SIZE = int(SAMPLE_RATE * VAD_FRAME_DURATION/1000)
+    PCM_BYTES = 2
+
+    # Longest utterance kept before it is transcribed without waiting for
+    # silence, Whisper decodes 30 second windows
+    MAX_UTTERANCE = 30 * SAMPLE_RATE
+
+    # Captured audio buffered for the inference worker, absorbs the time the
+    # worker spends transcribing an utterance
+    CAPTURE_BUFFER = 60 * SAMPLE_RATE
+
+    # Whisper segment timestamps are in 10 ms units
+    SEGMENT_TIME_UNIT = SAMPLE_RATE // 100
+
+    # Blocks read at once from the decoder of an uploaded file
+    DECODE_BLOCKS = 100
+    # Bytes of ffmpeg's stderr kept for a decoding error
+    DECODE_ERROR_TAIL = 4096
+
+
+class AudioRing:
+    """
+    Preallocated float32 ring buffer of samples.
+
+    Blocks are copied in without allocating; `read` copies the buffered
+    samples out in order, as one contiguous array for Whisper.
+    """
+
+    def __init__(self, capacity: int):
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.start = 0
+        self.size = 0
+
+    def free(self) -> int:
+        return self.capacity - self.size
+
+    def write(self, samples: np.ndarray):
+        n = len(samples)
+        if n > self.free():
+            raise OverflowError(f"Audio ring full, {n} samples dropped")
+
+        end = (self.start + self.size) % self.capacity
+        first = min(n, self.capacity - end)
+        self.buffer[end:end + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+        self.size += n
+
+    def peek(self) -> np.ndarray:
+        end = self.start + self.size
+        if end <= self.capacity:
+            return self.buffer[self.start:end].copy()
+        return np.concatenate(
+            [self.buffer[self.start:], self.buffer[:end - self.capacity]])
+
+    def read(self) -> np.ndarray:
+        out = self.peek()
+        self.start = 0
+        self.size = 0
+        return out
+
+    def discard(self, n: int):
+        """Drop the `n` oldest samples."""
+        n = min(n, self.size)
+        self.start = (self.start + n) % self.capacity
+        self.size -= n
+
+
+def _comparable(word: str) -> str:
+    return re.sub(r"[^\w']", "", word.lower())
+
+
+class LocalAgreement:
+    """
+    Commits the words of a growing utterance once two consecutive decodes
+    of it agree on them.
+
+    Whisper revises the end of a transcript as more audio arrives; a word
+    both passes produced, with everything before it, rarely changes again.
+    Words are compared ignoring case and punctuation, the latest pass
+    gives the committed form.
+    """
+
+    def __init__(self):
+        self.committed: list[str] = []
+        self.previous: list[str] = []
+
+    def update(self, words: list[str]) -> tuple[list[str], list[str]]:
+        """
+        Returns:
+            tuple[list[str], list[str]]: The newly committed words and the
+            words that are still tentative.
+        """
+        start = len(self.committed)
+        agreed = start
+        while agreed < min(len(words), len(self.previous)) \
+                and _comparable(words[agreed]) == _comparable(self.previous[agreed]):
+            agreed += 1
+
+        self.previous = words
+        new = words[start:agreed]
+        self.committed.extend(new)
+        return new, words[agreed:]
+
+    def finish(self, words: list[str]) -> list[str]:
+        """Commit what the last pass of an utterance adds to the committed words."""
+        new = words[len(self.committed):]
+        self.reset()
+        return new
+
+    def trim(self, n: int):
+        """Forget the first `n` committed words, their audio was dropped."""
+        self.committed = self.committed[n:]
+        self.previous = self.previous[n:]
+
+    def pending(self) -> bool:
+        return len(self.previous) > 0
+
+    def reset(self):
+        self.committed = []
+        self.previous = []
+
+
+class VoiceActivity:
+    """
+    webrtcvad over blocks of float32 samples.
+
+    Samples are converted to 16-bit PCM in place in scratch buffers and
+    handed to the VAD as read-only views of exact frames, without copies.
+    """
+
+    def __init__(self, vad):
+        self.vad = vad
+        self._scaled = np.zeros(AudioConstants.BLOCK_SIZE, dtype=np.float32)
+        self._pcm = np.zeros(AudioConstants.BLOCK_SIZE, dtype=np.int16)
+
+    def is_speech(self, samples: np.ndarray) -> bool:
+        """True if any whole VAD frame of the block has speech."""
+        pcm = self._to_pcm(samples)
+        frame = AudioConstants.VAD_FRAME_SIZE * AudioConstants.PCM_BYTES
+        for start in range(0, len(pcm) - frame + 1, frame):
+            if self.vad.is_speech(
+                    buf=pcm[start:start + frame], sample_rate=AudioConstants.SAMPLE_RATE):
+                return True
+        return False
+
+    def _to_pcm(self, samples: np.ndarray) -> memoryview:
+        n = len(samples)
+        if n > len(self._pcm):
+            self._scaled = np.zeros(n, dtype=np.float32)
+            self._pcm = np.zeros(n, dtype=np.int16)
+
+        scaled = self._scaled[:n]
+        np.clip(samples, -1.0, 1.0, out=scaled)
+        np.multiply(scaled, 32767, out=scaled)
+        np.copyto(self._pcm[:n], scaled, casting='unsafe')
+        return memoryview(self._pcm[:n]).cast('B').toreadonly()
+
+
+class SpeechChunker:
+    """
+    Cuts a stream of samples into chunks Whisper can decode independently.
+
+    A chunk ends at the first pause once it is `min_samples` long, or at
+    30 seconds whatever is said. Chunks in which the VAD heard no speech
+    are dropped. `feed` and `flush` return the chunks completed, with the
+    offset of their first sample in the stream.
+    """
+
+    def __init__(self, activity: VoiceActivity, min_samples: int):
+        self.activity = activity
+        self.min_samples = min(min_samples, AudioConstants.MAX_UTTERANCE)
+        self.chunk = AudioRing(AudioConstants.MAX_UTTERANCE)
+        self.start = 0
+        self.silenced_for = 0
+        self.has_speech = False
+
+    def feed(self, samples: np.ndarray) -> list[tuple[int, np.ndarray]]:
+        chunks = []
+        for i in range(0, len(samples), AudioConstants.BLOCK_SIZE):
+            block = samples[i:i + AudioConstants.BLOCK_SIZE]
+            if self.chunk.free() < len(block):
+                self._cut(chunks)
+
+            speech = self.activity.is_speech(block)
+            self.chunk.write(block)
+            self.has_speech = self.has_speech or speech
+            self.silenced_for = 0 if speech else self.silenced_for + 1
+
+            if self.chunk.size >= self.min_samples \
+                    and self.silenced_for >= AudioConstants.SILENCE_THRESHOLD:
+                self._cut(chunks)
+        return chunks
+
+    def flush(self) -> list[tuple[int, np.ndarray]]:
+        chunks = []
+        self._cut(chunks)
+        return chunks
+
+    def _cut(self, chunks: list[tuple[int, np.ndarray]]):
+        start = self.start
+        self.start += self.chunk.size
+        samples = self.chunk.read()
+        if self.has_speech:
+            chunks.append((start, samples))
+        self.silenced_for = 0
+        self.has_speech = False
+
+
+async def decode_audio(source: AsyncIterator[bytes], ffmpeg: str = "ffmpeg") -> AsyncIterator[np.ndarray]:
+    """
+    Decode any audio ffmpeg reads to mono float32 at Whisper's sample rate,
+    as it is received. Yields blocks of a few seconds; raises ValueError when
+    ffmpeg can't decode the input.
+
+    The input is piped, so containers that need seeking (MP4 with its index
+    at the end) aren't supported.
+    """
+    process = await asyncio.create_subprocess_exec(
+        ffmpeg, "-nostdin", "-loglevel", "error",
+        "-i", "pipe:0",
+        "-f", "f32le", "-ac", str(AudioConstants.CHANNELS), "-ar", str(AudioConstants.SAMPLE_RATE),
+        "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+
+    async def feed():
+        try:
+            async for data in source:
+                process.stdin.write(data)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg gave up on the input, its error is reported below
+            pass
+        finally:
+            process.stdin.close()
+
+    async def drain_errors() -> bytes:
+        # Read stderr as it is written, a full pipe would stall ffmpeg.
+        # Only the tail is kept for the error message
+        tail = b""
+        while data := await process.stderr.read(4096):
+            tail = (tail + data)[-AudioConstants.DECODE_ERROR_TAIL:]
+        return tail
+
+    feeder = asyncio.create_task(feed())
+    errors = asyncio.create_task(drain_errors())
+    read_size = AudioConstants.DECODE_BLOCKS * AudioConstants.BLOCK_SIZE * 4
+    try:
+        while True:
+            try:
+                data = await process.stdout.readexactly(read_size)
+            except asyncio.IncompleteReadError as e:
+                data = e.partial
+            if len(data) >= 4:
+                yield np.frombuffer(data, dtype=np.float32, count=len(data) // 4)
+            if len(data) < read_size:
+                break
+
+        await feeder
+        if await process.wait() != 0:
+            error = (await errors).decode(errors="replace").strip()
+            raise ValueError(f"Could not decode audio: {error}")
+    finally:
+        feeder.cancel()
+        errors.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+class CaptureRing:
+    """
+    Lock-free single producer, single consumer ring of float32 samples,
+    between the PortAudio callback and the inference worker.
+
+    Positions only grow and each is written by one side: the producer
+    publishes `written` after copying samples in, the consumer publishes
+    `consumed` after copying them out. Neither side ever waits on the other;
+    when the consumer falls behind by a whole buffer, new samples are
+    dropped and counted.
+    """
+
+    def __init__(self, capacity: int):
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.capacity = capacity
+        self.written = 0
+        self.consumed = 0
+        self.dropped = 0
+
+    def available(self) -> int:
+        return self.written - self.consumed
+
+    def write(self, samples: np.ndarray) -> bool:
+        n = len(samples)
+        if self.capacity - (self.written - self.consumed) < n:
+            self.dropped += n
+            return False
+
+        end = self.written % self.capacity
+        first = min(n, self.capacity - end)
+        self.buffer[end:end + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+        self.written += n
+        return True
+
+    def read_into(self, out: np.ndarray) -> bool:
+        """Fill `out` with the oldest samples, False if not enough are buffered."""
+        n = len(out)
+        if self.written - self.consumed < n:
+            return False
+
+        start = self.consumed % self.capacity
+        first = min(n, self.capacity - start)
+        out[:first] = self.buffer[start:start + first]
+        out[first:] = self.buffer[:n - first]
+        self.consumed += n
+        return True
+
 
 class AudioRecorder:
-    def __init__(self, registry: Registry, on_data: Callable[[str], None], on_error: Callable[[Exception], None]):
-        self.on_data = on_data
-        self.on_error = on_error
-        self.q = queue.Queue()
-        self.vad = registry.get_webrtc_vad()
-        self.model = registry.get_voice()
+    """
+    Captures an input device and transcribes what is said on it.
+
+    The PortAudio callback only copies samples into a `CaptureRing`. The
+    "AudioInference" thread reads them back block by block, finds speech
+    with the VAD, collects utterances and transcribes them on its
+    transcription session, sending segments to `on_data`. Capture never waits for
+    inference.
+
+    With a `partial_interval` (seconds), the utterance being spoken is also
+    decoded that often. Words two passes agree on are sent to `on_data`
+    as soon as they are stable, the rest to `on_partial`, replacing the
+    previous partial text. Audio of segments fully sent is dropped, so each
+    pass decodes a window sliding along the utterance.
+    """
+
+    def __init__(self, registry: Registry, session: TranscriptionSession, on_data: Callable[[str], None], on_error: Callable[[Exception], None],
+                 on_partial: Callable[[str], None] = None, partial_interval: float = 0):
         self.on_data = on_data
         self.on_error = on_error
+        self.on_partial = on_partial
+        self.partial_interval = partial_interval if on_partial is not None else 0
+        self.vad = VoiceActivity(registry.get_webrtc_vad())
+        self.session = session
         self.stream = None
+        self.worker = None
         self.silenced_for = 0
+        self.capture = CaptureRing(AudioConstants.CAPTURE_BUFFER)
+        self.speech = AudioRing(AudioConstants.MAX_UTTERANCE)
+        self.agreement = LocalAgreement()
+        self.partial = ""
+        self._decoded_at = 0.0
+        self._stopping = threading.Event()
+        # Scratch buffers of the inference worker, reused for every block
+        self._block = np.zeros(AudioConstants.BLOCK_SIZE, dtype=np.float32)
+        self._padding = np.zeros(AudioConstants.SAMPLE_RATE + 10, dtype=np.float32)
 
     def start(self, device):
+        self._stopping.clear()
+        self.worker = threading.Thread(
+            target=self._run, name="AudioInference", daemon=True)
+        self.worker.start()
+
         self.stream = sd.InputStream(
             samplerate=AudioConstants.SAMPLE_RATE,
             channels=AudioConstants.CHANNELS,
             blocksize=AudioConstants.BLOCK_SIZE,
             callback=self._callback,
-            device=device
+            device=device,
+            dtype='float32'
         )
         self.stream.start()
 
     def stop(self):
+        """Stop capturing and wait for the inference worker to finish."""
         logger.info("Stopping audio recording")
         if self.stream is not None:
             self.stream.stop()
             self.stream.close()
             self.stream = None
+        self._stopping.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+        if self.capture.dropped > 0:
+            logger.warning(
+                f"Inference fell behind, {self.capture.dropped} audio samples dropped")
 
     def _callback(self, indata: np.ndarray, frames: int, time, status):
-        # print(indata)
         if status:
             logger.error(f"Audio stream error: {status}")
+        self.capture.write(indata[:, 0])
+
+    def _run(self):
+        # Sleeping a block between polls keeps the callback free of any
+        # synchronization, at the cost of up to one block of latency
+        poll = AudioConstants.BLOCK_DURATION / 1000
         try:
-            f16np = self._normalize(indata)
-            b = f16np.tobytes()
-            has_speech = self._find_speech(b)
-            if not has_speech:
-                if self.silenced_for >= AudioConstants.SILENCE_THRESHOLD:
-                    # Ensure that if user talks too little, or accidental sounds
-                    # we would not transcribe audio
-                    if self.q.qsize() >= AudioConstants.Q_THRESHOLD:
-                        logger.info(
-                            "Silence threshold reached, processing queue")
-                        self.silenced_for = 0
-                        self._transcribe()
-                self.silenced_for += 1
-            else:
-                self.silenced_for = 0
-                self.q.put(f16np)
+            while not self._stopping.is_set():
+                while not self._stopping.is_set() and self.capture.read_into(self._block):
+                    self._process(self._block)
+                if self._partial_due():
+                    self._decode_partial()
+                self._stopping.wait(poll)
+
+            if self.partial_interval > 0:
+                self._finish()
         except Exception as e:
             logger.error(f"Error handling audio block: {e}")
             self.on_error(e)
 
+    def _finish(self):
+        """
+        Commit the utterance still being spoken on stop, words the client
+        was shown as partial text would be lost otherwise.
+        """
+        while self.capture.read_into(self._block):
+            self._process(self._block)
+        if self.speech.size > 0 and (self.agreement.pending()
+                                     or self.speech.size >= AudioConstants.Q_THRESHOLD * AudioConstants.BLOCK_SIZE):
+            self._transcribe()
+        self.agreement.reset()
+        self._commit([], [])
+
+    def _process(self, samples: np.ndarray):
+        has_speech = self.vad.is_speech(samples)
+        if not has_speech:
+            if self.silenced_for >= AudioConstants.SILENCE_THRESHOLD:
+                # Ensure that if user talks too little, or accidental sounds
+                # we would not transcribe audio
+                if self.speech.size >= AudioConstants.Q_THRESHOLD * AudioConstants.BLOCK_SIZE \
+                        or (self.agreement.pending() and self.speech.size > 0):
+                    logger.info(
+                        "Silence threshold reached, processing queue")
+                    self.silenced_for = 0
+                    self._transcribe()
+            self.silenced_for += 1
+        else:
+            self.silenced_for = 0
+            if self.speech.free() < len(samples):
+                logger.info("Utterance too long, processing queue")
+                self._transcribe()
+            self.speech.write(samples)
+
     def _transcribe(self):
-        audio_chunks = []
-        while not self.q.empty():
-            f16np = self.q.get()
-            audio_chunks.append(f16np)
-        if not audio_chunks:
+        if self.speech.size == 0:
             logger.info("No audio chunks to process")
             return
-        merged = np.concatenate(audio_chunks)
+
+        if self.partial_interval > 0:
+            words = self._decode(self.speech.read())[1]
+            self._commit(self.agreement.finish(words), [])
+            return
 
         # Appending zeros to the audio data as a workaround for small audio packets (small commands)
-        merged = np.concatenate(
-            [merged, np.zeros(int(AudioConstants.SAMPLE_RATE) + 10)])
+        merged = np.concatenate([self.speech.read(), self._padding])
 
         def _segcall(segment: Segment):
             self.on_data(segment.text)
 
-        return self.model.transcribe(media=merged, new_segment_callback=_segcall)
+        return self.session.transcribe(merged, new_segment_callback=_segcall)
+
+    def _partial_due(self) -> bool:
+        return self.partial_interval > 0 \
+            and self.silenced_for == 0 \
+            and self.speech.size >= AudioConstants.Q_THRESHOLD * AudioConstants.BLOCK_SIZE \
+            and time.monotonic() - self._decoded_at >= self.partial_interval
 
-    def _normalize(self, raw: np.ndarray) -> np.ndarray:
-        ranged = map(lambda x: (x + 1) / 2, raw)  # [-1, 1] to [0, 1]
-        f16np = np.fromiter(ranged, np.float16)
-        return f16np
+    def _decode_partial(self):
+        segments, words = self._decode(self.speech.peek())
+        new, tentative = self.agreement.update(words)
+        self._commit(new, tentative)
 
-    def _find_speech(self, audio: bytes) -> bool:
-        detect = self.vad.is_speech(
-            buf=audio, sample_rate=AudioConstants.SAMPLE_RATE)
+        # Slide the window past segments whose words were all sent, keeping
+        # the last one, Whisper may still revise it
+        sent = len(self.agreement.committed)
+        counted = 0
+        cut = None
+        for segment in segments[:-1]:
+            counted += len(segment.text.split())
+            if counted > sent:
+                break
+            cut = (segment, counted)
+        if cut is not None:
+            segment, counted = cut
+            self.speech.discard(int(segment.t1) * AudioConstants.SEGMENT_TIME_UNIT)
+            self.agreement.trim(counted)
+
+    def _decode(self, samples: np.ndarray) -> tuple[list[Segment], list[str]]:
+        self._decoded_at = time.monotonic()
+        # Appending zeros to the audio data as a workaround for small audio packets (small commands)
+        segments = self.session.transcribe(np.concatenate([samples, self._padding]))
+        return segments, [w for s in segments for w in s.text.split()]
 
-        return detect
+    def _commit(self, words: list[str], tentative: list[str]):
+        if len(words) > 0:
+            self.on_data(" " + " ".join(words))
+        partial = " ".join(tentative)
+        if partial != self.partial:
+            self.partial = partial
+            self.on_partial(partial)
 
 
 def get_inputs() -> list:
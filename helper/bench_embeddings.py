@@ -0,0 +1,70 @@
+"""
+Compare embeddings providers on document throughput and query latency.
+
+    python bench_embeddings.py -providers openai,local -documents 512 -queries 50
+
+Providers are configured from the same config file as the API (`-config`).
+Calls go to the providers directly, bypassing the embedding cache.
+"""
+import argparse
+import random
+import statistics
+import time
+from config import read_config
+from embed_provider import init_provider
+
+WORDS = (
+    "task note board review deadline meeting design draft release bug fix "
+    "deploy database index query cache latency memory thread voice model "
+    "summary priority backlog sprint estimate refactor test build client"
+).split()
+
+
+def sample_texts(count: int, words: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    return [" ".join(rng.choices(WORDS, k=words)) for _ in range(count)]
+
+
+def percentile(values: list[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+def bench(name: str, configs, documents: int, queries: int, words: int, batch: int):
+    start = time.perf_counter()
+    embeddings, model = init_provider(configs, name)
+    startup = time.perf_counter() - start
+
+    texts = sample_texts(documents, words, seed=1)
+    start = time.perf_counter()
+    for i in range(0, len(texts), batch):
+        embeddings.embed_documents(texts[i:i + batch])
+    elapsed = time.perf_counter() - start
+
+    latencies = []
+    for text in sample_texts(queries, 8, seed=2):
+        start = time.perf_counter()
+        embeddings.embed_query(text)
+        latencies.append(time.perf_counter() - start)
+
+    if hasattr(embeddings, "close"):
+        embeddings.close()
+
+    print(f"{name:<8} {model:<40} startup {startup:6.2f}s  "
+          f"documents {documents / elapsed:8.1f}/s  "
+          f"query p50 {statistics.median(latencies) * 1000:7.1f}ms  "
+          f"p95 {percentile(latencies, 0.95) * 1000:7.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark embeddings providers")
+    parser.add_argument("-providers", type=str, default="openai,local")
+    parser.add_argument("-documents", type=int, default=512)
+    parser.add_argument("-queries", type=int, default=50)
+    parser.add_argument("-words", type=int, default=60, help="Words per document")
+    args, _ = parser.parse_known_args()
+
+    configs = read_config()
+    batch = configs['embeddings'].getint('batchSize', 256)
+    for provider in args.providers.split(","):
+        bench(provider.strip(), configs, args.documents, args.queries, args.words, batch)
@@ -12,19 +12,19 @@ logger = logging.getLogger(__name__)
 
 @router.post("/thread")
 async def create_thread(body: CreateThreadRequest):
-    id = service.create_thread(body)
+    id = await service.acreate_thread(body)
     return {"id": id}
 
 
 @router.get("/threads")
 async def list_threads():
-    threads = service.list_threads()
+    threads = await service.alist_threads()
     return {"threads": [t.to_dict() for t in threads]}
 
 
 @router.get("/thread/{id}")
 async def get_thread(id: str):
-    thread = service.get_thread(id)
+    thread = await service.aget_thread(id)
     if thread:
         return thread
     raise HTTPException(status_code=404, detail=f"Thread {id} not found")
@@ -58,6 +58,12 @@ async def safe_generator(gen):
 
 
 @router.get("/thread/{id}/messages")
-async def get_messages(id: str, page: int, limit: int):
-    messages = service.get_messages(id, page, limit)
-    return {"messages": [m.to_dict() for m in messages]}
+async def get_messages(id: int, limit: int = 50, cursor: str | None = None):
+    try:
+        page = await service.aget_messages(id, limit, cursor)
+        return page.to_dict()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error getting messages: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error.")
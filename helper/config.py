@@ -25,13 +25,39 @@ def get_default(parser: configparser.ConfigParser):
         'token': os.getenv(key='OPENAI_API_KEY', default=''),
         'name': 'gpt-3.5-turbo',  # Model name
         'baseUrl': 'https://api.openai.com/v1',  # Path
+        'speculative': 'false',  # Start the model before mem0 retrieval completes
+        'graceWindow': '150',  # Milliseconds to wait for mem0 in speculative mode
+        'historyTurns': '6',  # Previous turns of the thread sent with each message
+        'contextBudget': '3000',  # Prompt tokens for instructions, context, history and the message
+        'contextPriority': 'history,tasks,notes,memory',  # Order sections are kept in when over budget
+        'responseCache': 'false',  # Replay answers to near-identical questions until a note or task changes
+        'responseCacheTtl': '600',  # Seconds a cached answer is replayed
+        'responseCacheSimilarity': '0.95',  # Minimum cosine similarity between question embeddings
+        'responseCacheSize': '256',  # Cached answers kept
     }
     parser['voice'] = {
         'name': 'base-q5_1',  # Model name
         'directory': 'MODELS',  # Path to models directory
+        'contexts': '0',  # Model contexts decoding at once, each loads the model, 0 is a quarter of the cores
+        'threads': '0',  # Threads per context, 0 shares the cores between contexts
+        'maxSessions': '0',  # Live recordings and uploads transcribed at once, 0 is twice the contexts
+        'overload': 'reject',  # Past maxSessions: reject, or queue until a session ends
+        'queueTimeout': '30',  # Seconds a queued session waits before it is rejected
+        'chunkSeconds': '20',  # Uploaded audio is cut at the first pause past this many seconds, chunks decode in parallel
+        'ffmpeg': 'ffmpeg',  # ffmpeg binary decoding uploaded audio
+        'partialInterval': '400',  # ms between partial transcripts while speaking, 0 sends text only after pauses
     }
     parser['sqlite'] = {
         'path': 'DATA/data.db',  # Path to SQLite database
+        'workers': '4',  # Threads running database calls for async routes
+        'readers': '4',  # Pooled read connections, writes use a single connection
+        'cacheSize': '-20000',  # PRAGMA cache_size, negative values are in KiB
+        'mmapSize': '268435456',  # PRAGMA mmap_size in bytes
+        'tempStore': 'MEMORY',  # PRAGMA temp_store
+        'busyTimeout': '5000',  # PRAGMA busy_timeout in milliseconds
+        'auditQueries': 'off',  # Check query plans for full scans: off, warn or raise
+        'migrationBatch': '500',  # Rows per transaction in background migration backfills
+        'migrationPause': '50',  # Pause between backfill batches in milliseconds
     }
     parser['notes'] = {
         'vector': 'DATA/notes.db',  # Path to notes vector database
@@ -39,14 +65,43 @@ def get_default(parser: configparser.ConfigParser):
     parser['tasks'] = {
         'vector': 'DATA/tasks.db',  # Path to tasks vector database
     }
+    parser['indexer'] = {
+        'debounce': '250',  # Milliseconds to coalesce writes before indexing
+        'reconcile': '300',  # Seconds between full sweeps for missed changes
+    }
     parser['embeddings'] = {
+        # Provider: openai or local. Vectors of different models don't mix,
+        # delete the notes, tasks and memory vector databases after changing it.
+        'provider': 'openai',
         'name': 'text-embedding-3-small',  # Model name
         'baseUrl': 'https://api.openai.com/v1',  # Path
         'token': os.getenv(key='OPENAI_API_KEY', default=''),
+        'batchSize': '256',  # Max chunks per embeddings request
+        'batchTokens': '8000',  # Max estimated tokens per embeddings request
+        'concurrency': '2',  # Max embeddings requests in flight
+        'cache': 'DATA/embeddings.db',  # Path to embedding cache database
+        'cacheSize': '256',  # Max size of the embedding cache in MB
+        'cacheItems': '10000',  # Max embeddings kept in memory
+        'localName': 'sentence-transformers/all-MiniLM-L6-v2',  # Model of the local provider
+        'localBackend': 'torch',  # Local inference backend: torch or onnx
+        'localDevice': 'cpu',  # Device of the local provider
+        'localWorkers': '2',  # Threads running local inference
+        'localBatchSize': '32',  # Texts per local inference batch
+    }
+    parser['retrieval'] = {
+        'budget': '1500',  # Milliseconds for all retrieval sources together
+        'memoryTimeout': '1200',  # Milliseconds for the mem0 source
+        'notesTimeout': '500',  # Milliseconds for the notes index
+        'tasksTimeout': '500',  # Milliseconds for the tasks index
+        'redundancy': '0.95',  # Cosine similarity of stored vectors above which a document is a duplicate
+        'simhashDistance': '3',  # Max differing SimHash bits of duplicates without stored vectors
     }
     parser['memory'] = {
         'history': 'DATA/memory.db',  # Path to memory database
         'vector': 'DATA/vector.db',  # Path to vector database
+        'workers': '2',  # Concurrent memory writes
+        'queueSize': '64',  # Threads with turns waiting to be written
+        'policy': 'block',  # When the queue is full: block or drop
     }
 
 
@@ -0,0 +1,271 @@
+import asyncio
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingStore:
+    """
+    Persistent embedding cache in SQLite, evicting the least recently used
+    vectors once the total stored size goes above `max_bytes`.
+    """
+
+    BATCH = 500
+
+    def __init__(self, path: str, max_bytes: int):
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            )""")
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_embeddings_accessed_at ON embeddings (accessed_at)")
+        self._conn.commit()
+        self._size = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+        logger.info(
+            f"Using embedding cache at: {path} ({self._size // 1024} KiB)")
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        found = {}
+        now = time.time()
+
+        with self._lock:
+            for i in range(0, len(keys), self.BATCH):
+                batch = keys[i:i + self.BATCH]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", batch).fetchall()
+                for key, blob in rows:
+                    found[key] = array('f', blob).tolist()
+
+                if len(rows) > 0:
+                    self._conn.execute(
+                        f"UPDATE embeddings SET accessed_at = ? WHERE key IN ({marks})", [now, *batch])
+            self._conn.commit()
+
+        return found
+
+    def put_many(self, vectors: dict[str, list[float]]):
+        now = time.time()
+        rows = []
+        for key, vector in vectors.items():
+            blob = array('f', vector).tobytes()
+            rows.append((key, blob, len(blob), now))
+
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, size, accessed_at) VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._size += sum(r[2] for r in rows)
+
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Shrink to 90% so that eviction is not triggered by every insert
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+
+        while self._size > target:
+            rows = self._conn.execute(
+                "SELECT key, size FROM embeddings ORDER BY accessed_at ASC LIMIT ?", (self.BATCH,)).fetchall()
+            if len(rows) == 0:
+                self._size = 0
+                break
+
+            self._conn.executemany(
+                "DELETE FROM embeddings WHERE key = ?", [(r[0],) for r in rows])
+            self._size -= sum(r[1] for r in rows)
+            evicted += len(rows)
+
+        self._conn.commit()
+        logger.debug(f"Evicted {evicted} cached embeddings")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that only sends text it has never seen to the provider.
+
+    Vectors are keyed by model name and a hash of the normalized text, looked
+    up in an in-memory LRU first and the SQLite store second. Concurrent
+    requests for the same text (e.g. several retrievers embedding one query)
+    share a single provider call.
+    """
+
+    def __init__(self, embeddings: Embeddings, model: str, store: EmbeddingStore, memory_items: int):
+        self.embeddings = embeddings
+        self.model = model
+        self.store = store
+        self.memory_items = memory_items
+        self._lru: OrderedDict[str, list[float]] = OrderedDict()
+        self._inflight: dict[str, Future] = {}
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._resolve(texts, "document", lambda missing: self.embeddings.embed_documents(missing))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._resolve([text], "query", lambda missing: [self.embeddings.embed_query(missing[0])])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self._aresolve(texts, "document", self.embeddings.aembed_documents)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        async def compute(missing: list[str]) -> list[list[float]]:
+            return [await self.embeddings.aembed_query(missing[0])]
+        return (await self._aresolve([text], "query", compute))[0]
+
+    def close(self):
+        if hasattr(self.embeddings, "close"):
+            self.embeddings.close()
+        self.store.close()
+
+    def _key(self, text: str, kind: str) -> str:
+        normalized = " ".join(unicodedata.normalize("NFC", text).split())
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        return f"{self.model}:{kind}:{digest}"
+
+    def _resolve(self, texts: list[str], kind: str, compute) -> list[list[float]]:
+        keys, found, missing = self._lookup(texts, kind)
+        if len(missing) > 0:
+            self._load(found, missing)
+        owned, waiting = self._claim(found, missing)
+
+        if len(owned) > 0:
+            try:
+                vectors = compute(list(owned.values()))
+            except BaseException as e:
+                # Also on cancellation (a retrieval deadline), or the
+                # owned futures would never resolve and block later calls
+                self._fail(owned, e)
+                raise
+            computed = self._complete(owned, vectors)
+            found.update(computed)
+            self._persist(computed)
+
+        for key, future in waiting.items():
+            found[key] = future.result()
+
+        return [found[k] for k in keys]
+
+    async def _aresolve(self, texts: list[str], kind: str, compute) -> list[list[float]]:
+        keys, found, missing = self._lookup(texts, kind)
+        if len(missing) > 0:
+            # The store is SQLite, kept off the event loop
+            await asyncio.to_thread(self._load, found, missing)
+        owned, waiting = self._claim(found, missing)
+
+        if len(owned) > 0:
+            try:
+                vectors = await compute(list(owned.values()))
+            except BaseException as e:
+                # Also on cancellation (a retrieval deadline), or the
+                # owned futures would never resolve and block later calls
+                self._fail(owned, e)
+                raise
+            computed = self._complete(owned, vectors)
+            found.update(computed)
+            await asyncio.to_thread(self._persist, computed)
+
+        for key, future in waiting.items():
+            # Shielded, a cancelled waiter must not cancel the future the
+            # owner and other waiters share
+            found[key] = await asyncio.shield(asyncio.wrap_future(future))
+
+        return [found[k] for k in keys]
+
+    def _lookup(self, texts: list[str], kind: str):
+        keys = [self._key(t, kind) for t in texts]
+        found = {}
+        missing = {}
+
+        with self._lock:
+            for key, text in zip(keys, texts):
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    found[key] = self._lru[key]
+                else:
+                    missing[key] = text
+        return keys, found, missing
+
+    def _load(self, found: dict[str, list[float]], missing: dict[str, str]):
+        stored = self.store.get_many(list(missing.keys()))
+        for key, vector in stored.items():
+            found[key] = vector
+            del missing[key]
+        self._remember(stored)
+
+    def _claim(self, found: dict[str, list[float]], missing: dict[str, str]):
+        owned = {}
+        waiting = {}
+        with self._lock:
+            for key, text in missing.items():
+                if key in self._inflight:
+                    waiting[key] = self._inflight[key]
+                else:
+                    self._inflight[key] = Future()
+                    owned[key] = text
+
+        logger.debug(
+            f"Embedding cache: {len(found)} hits, {len(owned)} misses, {len(waiting)} in flight")
+        return owned, waiting
+
+    def _complete(self, owned: dict[str, str], vectors: list[list[float]]) -> dict[str, list[float]]:
+        computed = dict(zip(owned.keys(), vectors))
+        self._remember(computed)
+
+        with self._lock:
+            for key, vector in computed.items():
+                future = self._inflight.pop(key)
+                if not future.done():
+                    future.set_result(vector)
+        return computed
+
+    def _persist(self, computed: dict[str, list[float]]):
+        try:
+            self.store.put_many(computed)
+        except Exception as e:
+            # The vectors are still good, only later runs will miss them
+            logger.error(f"Failed to persist {len(computed)} embeddings: {e}")
+
+    def _fail(self, owned: dict[str, str], e: BaseException):
+        if not isinstance(e, Exception):
+            e = RuntimeError("Embedding request was cancelled")
+        with self._lock:
+            for key in owned.keys():
+                future = self._inflight.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+
+    def _remember(self, vectors: dict[str, list[float]]):
+        with self._lock:
+            for key, vector in vectors.items():
+                self._lru[key] = vector
+                self._lru.move_to_end(key)
+            while len(self._lru) > self.memory_items:
+                self._lru.popitem(last=False)
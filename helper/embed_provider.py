@@ -0,0 +1,116 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+import logging
+import threading
+import time
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+from pydantic import SecretStr
+
+logger = logging.getLogger(__name__)
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Sentence-transformers model (torch or ONNX backend) run on the CPU, so
+    indexing and queries don't need the network.
+
+    Texts are split into batches of `batch_size` spread over `workers`
+    threads sharing one model; both backends release the GIL during
+    inference. Call `warm_up` at startup so the first request doesn't pay
+    for loading the model.
+    """
+
+    def __init__(self, model: str, workers: int, batch_size: int, device: str, backend: str):
+        self.model = model
+        self.workers = workers
+        self.batch_size = batch_size
+        self.device = device
+        self.backend = backend
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embeddings")
+        self._encoder = None
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        futures = [self.pool.submit(self._encode, batch)
+                   for batch in self._batches(texts)]
+        return [vector for future in futures for vector in future.result()]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            loop.run_in_executor(self.pool, self._encode, batch)
+            for batch in self._batches(texts)])
+        return [vector for result in results for vector in result]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    def warm_up(self):
+        """Load the model and run one batch through every worker."""
+        start = time.perf_counter()
+        futures = [self.pool.submit(self._encode, ["warm up"])
+                   for _ in range(self.workers)]
+        for future in futures:
+            future.result()
+        logger.info(
+            f"Local embeddings model {self.model} ({self.backend}) ready after {time.perf_counter() - start:.1f}s")
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def _encode(self, texts: list[str]) -> list[list[float]]:
+        return self._load().encode(
+            texts,
+            batch_size=self.batch_size,
+            normalize_embeddings=True,
+            convert_to_numpy=True).tolist()
+
+    def _load(self):
+        with self._lock:
+            if self._encoder is None:
+                # Optional dependency, only needed with the local provider
+                from sentence_transformers import SentenceTransformer
+                self._encoder = SentenceTransformer(
+                    self.model, device=self.device, backend=self.backend)
+            return self._encoder
+
+    def _batches(self, texts: list[str]) -> list[list[str]]:
+        return [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+
+
+def init_provider(configs: ConfigParser, provider: str = None) -> tuple[Embeddings, str]:
+    """
+    Create the embeddings provider selected by `[embeddings] provider`.
+
+    Returns:
+        tuple[Embeddings, str]: The provider and the name of its model.
+    """
+    embeddings = configs['embeddings']
+    provider = provider or embeddings.get('provider', 'openai')
+
+    if provider == 'openai':
+        model = embeddings['name']
+        return OpenAIEmbeddings(
+            api_key=SecretStr(embeddings['token']),
+            base_url=embeddings['baseUrl'],
+            model=model,
+            max_retries=3
+        ), model
+
+    if provider == 'local':
+        model = embeddings.get('localName', 'sentence-transformers/all-MiniLM-L6-v2')
+        local = LocalEmbeddings(
+            model=model,
+            workers=embeddings.getint('localWorkers', 2),
+            batch_size=embeddings.getint('localBatchSize', 32),
+            device=embeddings.get('localDevice', 'cpu'),
+            backend=embeddings.get('localBackend', 'torch'))
+        local.warm_up()
+        return local, model
+
+    raise ValueError(f"Unknown embeddings provider: {provider}")
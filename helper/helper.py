@@ -1,6 +1,8 @@
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
 from setup import registry
 from services.config import ConfigService
+from services.metrics import metrics
 
 
 router = APIRouter(prefix="/api")
@@ -9,12 +11,12 @@ config_service = ConfigService(registry)
 
 @router.get("/config")
 async def get_config():
-    return [c.to_dict() for c in config_service.list()]
+    return [c.to_dict() for c in (await config_service.alist())]
 
 
 @router.get("/config/{key}")
 async def get_config(key: str):
-    config = config_service.get(key)
+    config = await config_service.aget(key)
     if config is None:
         raise HTTPException(status_code=404, detail=f"Config {key} not found")
     return config.to_dict()
@@ -22,11 +24,16 @@ async def get_config(key: str):
 
 @router.post("/config/{key}")
 async def set_config(key: str, value: str):
-    config_service.set(key, value)
+    await config_service.aset(key, value)
     return {"message": f"Config {key} set"}
 
 
 @router.delete("/config/{key}")
 async def delete_config(key: str):
-    config_service.unset(key)
+    await config_service.aunset(key)
     return {"message": f"Config {key} deleted"}
+
+
+@router.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -1,6 +1,6 @@
 import logging
 from fastapi import APIRouter, HTTPException
-from services.kanban import CreateKanbanRequest, MoveKanbanRequest, UpdateKanbanRequest
+from services.kanban import CreateKanbanRequest, InvalidMoveError, MoveKanbanRequest, UpdateKanbanRequest
 from services.kanban import kb_service as service
 
 router = APIRouter(prefix="/kanban")
@@ -11,7 +11,7 @@ logger = logging.getLogger(__name__)
 @router.post("")
 async def create_kanban(request: CreateKanbanRequest):
     try:
-        return service.create(request)
+        return await service.acreate(request)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -19,10 +19,11 @@ async def create_kanban(request: CreateKanbanRequest):
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 
-@router.get("{id}")
+@router.get("/{id}")
 async def get_kanban(id: int):
     try:
-        return service.get(id)
+        task = await service.aget(id)
+        return task.to_dict()
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -30,10 +31,10 @@ async def get_kanban(id: int):
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 
-@router.put("{id}")
+@router.put("/{id}")
 async def update_kanban(id: int, request: UpdateKanbanRequest):
     try:
-        return service.update(id, request)
+        return await service.aupdate(id, request)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -41,10 +42,10 @@ async def update_kanban(id: int, request: UpdateKanbanRequest):
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 
-@router.delete("{id}")
+@router.delete("/{id}")
 async def delete_kanban(id: int):
     try:
-        return service.delete(id)
+        return await service.adelete(id)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -55,7 +56,9 @@ async def delete_kanban(id: int):
 @router.post("/move")
 async def move_kanban(request: MoveKanbanRequest):
     try:
-        return service.move(request)
+        return await service.amove(request)
+    except InvalidMoveError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -64,5 +67,11 @@ async def move_kanban(request: MoveKanbanRequest):
 
 
 @router.get("")
-async def list_kanban():
-    return service.list_by_board()
+async def list_kanban(limit: int = 50, board: str | None = None, cursor: str | None = None):
+    try:
+        return await service.alist_by_board(limit, board, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error listing kanban: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error.")
@@ -1,9 +1,11 @@
 import asyncio
+from contextlib import asynccontextmanager
 import logging
 from fastapi import FastAPI
 from hypercorn.asyncio import serve
 from config import set_cors
 from services import models
+from services.migrations import MigrationRunner
 import voice
 from setup import registry
 import chat
@@ -11,22 +13,32 @@ import helper
 import notes
 import kanban
 from services.indexer import DocumentIndexer
+from services.memory_writer import memory_writer
 from log import get_hypercorn_config
 
 
 logger = logging.getLogger(__name__)
 
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await memory_writer.drain(timeout=30)
+
+
 if __name__ == "__main__":
     configs = registry.get_configs()
     port = configs['http'].getint('port', 8768)
     alchemy = registry.get_alchemy()
     models.init_models(alchemy.engine)
+    migrations = MigrationRunner.from_registry(registry)
+    migrations.run()
     logger.info(f"Starting Sidecar API on port {port}")
 
     app = FastAPI(title="Sidecar API",
                   description="API for Sidecar services",
-                  version="1.0.0")
+                  version="1.0.0",
+                  lifespan=lifespan)
     set_cors(app=app)
 
     app.include_router(chat.router)
@@ -37,11 +49,13 @@ if __name__ == "__main__":
 
     indexer = DocumentIndexer(registry)
     indexer.start()
+    migrations.start()
 
     try:
         asyncio.run(serve(app,
                           config=get_hypercorn_config(configs)))
     finally:
-        registry.close()
+        migrations.stop()
         indexer.stop()
+        registry.close()
         logger.info("Sidecar API stopped")
@@ -11,13 +11,13 @@ logger = logging.getLogger(__name__)
 
 @router.post("")
 async def create_note(request: CreateNoteRequest):
-    return service.create(request)
+    return await service.acreate(request)
 
 
 @router.get("{id}")
 async def get_note(id: int):
     try:
-        return service.get(id)
+        return await service.aget(id)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -27,7 +27,7 @@ async def get_note(id: int):
 @router.put("{id}")
 async def update_note(id: int, request: UpdateNoteRequest):
     try:
-        service.update(id, request)
+        await service.aupdate(id, request)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -37,7 +37,7 @@ async def update_note(id: int, request: UpdateNoteRequest):
 @router.delete("{id}")
 async def delete_note(id: int):
     try:
-        service.delete(id)
+        await service.adelete(id)
     except ValueError as e:
         raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
@@ -46,4 +46,4 @@ async def delete_note(id: int):
 
 @router.get("")
 async def list_notes():
-    return service.list()
+    return await service.alist()
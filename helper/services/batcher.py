@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import uuid
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class PendingChunk:
+    def __init__(self, store: Chroma, text: str, metadata: dict[str, any]):
+        self.id = str(uuid.uuid4())
+        self.store = store
+        self.text = text
+        self.metadata = metadata
+        self.vector: list[float] = None
+
+    def tokens(self) -> int:
+        # Rough estimate (~4 characters per token), good enough for capping request sizes
+        return len(self.text) // 4 + 1
+
+
+class EmbeddingBatcher:
+    """
+    Embeds chunks for many documents with as few provider requests as possible.
+
+    Chunks are packed into batches capped by item count and estimated tokens,
+    at most `concurrency` batches are in flight at once, and the resulting
+    vectors are written to the vector store each chunk belongs to.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_items: int, max_tokens: int, concurrency: int):
+        self.embeddings = embeddings
+        self.max_items = max_items
+        self.max_tokens = max_tokens
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    def batches(self, chunks: list[PendingChunk]) -> list[list[PendingChunk]]:
+        batches = []
+        current = []
+        current_tokens = 0
+
+        for chunk in chunks:
+            tokens = chunk.tokens()
+            if len(current) > 0 and (len(current) >= self.max_items or current_tokens + tokens > self.max_tokens):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(chunk)
+            current_tokens += tokens
+
+        if len(current) > 0:
+            batches.append(current)
+        return batches
+
+    async def run(self, chunks: list[PendingChunk]):
+        if len(chunks) == 0:
+            return
+
+        batches = self.batches(chunks)
+        logger.debug(
+            f"Embedding {len(chunks)} chunks in {len(batches)} requests")
+
+        await asyncio.gather(*[self._embed(batch) for batch in batches])
+        self._write(chunks)
+
+    async def _embed(self, batch: list[PendingChunk]):
+        async with self.semaphore:
+            vectors = await self.embeddings.aembed_documents([c.text for c in batch])
+
+        for chunk, vector in zip(batch, vectors):
+            chunk.vector = vector
+
+    def _write(self, chunks: list[PendingChunk]):
+        by_store: dict[int, list[PendingChunk]] = {}
+        for chunk in chunks:
+            by_store.setdefault(id(chunk.store), []).append(chunk)
+
+        for group in by_store.values():
+            store = group[0].store
+            store._collection.upsert(
+                ids=[c.id for c in group],
+                embeddings=[c.vector for c in group],
+                documents=[c.text for c in group],
+                metadatas=[c.metadata for c in group],
+            )
@@ -0,0 +1,85 @@
+from enum import Enum
+import logging
+import threading
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentKind(Enum):
+    NOTE = "note"
+    TASK = "task"
+
+
+class ChangeBatch:
+    def __init__(self):
+        self.notes: set[int] = set()
+        self.tasks: set[int] = set()
+
+    def is_empty(self) -> bool:
+        return len(self.notes) == 0 and len(self.tasks) == 0
+
+    def __repr__(self):
+        return f"ChangeBatch(notes={len(self.notes)}, tasks={len(self.tasks)})"
+
+
+class ChangeFeed:
+    """
+    In-process feed of note and task writes.
+
+    Writers publish the id of every row they mark dirty or for removal, the
+    indexer drains the pending ids. Repeated writes to the same row before a
+    drain are coalesced into a single entry. Subscribers are called on every
+    publish, on the writer's thread, and must not block.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = ChangeBatch()
+        self._signal = threading.Event()
+        self._listeners: list[Callable[[DocumentKind, int], None]] = []
+
+    def subscribe(self, listener: Callable[[DocumentKind, int], None]):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def publish(self, kind: DocumentKind, id: int):
+        if id is None:
+            return
+
+        with self._lock:
+            if kind == DocumentKind.NOTE:
+                self._pending.notes.add(id)
+            else:
+                self._pending.tasks.add(id)
+            self._signal.set()
+            listeners = list(self._listeners)
+
+        for listener in listeners:
+            try:
+                listener(kind, id)
+            except Exception as e:
+                logger.error(f"Change listener failed for {kind.value} {id}: {e}", exc_info=True)
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Block until a change is published or the timeout expires.
+
+        Returns:
+            bool: True if there are pending changes.
+        """
+        return self._signal.wait(timeout=timeout)
+
+    def drain(self) -> ChangeBatch:
+        with self._lock:
+            batch = self._pending
+            self._pending = ChangeBatch()
+            self._signal.clear()
+        return batch
+
+    def wake(self):
+        """Wake up waiters without publishing anything, used on shutdown."""
+        self._signal.set()
+
+
+change_feed = ChangeFeed()
@@ -1,11 +1,13 @@
 import asyncio
 from datetime import datetime, timedelta
 import logging
+import re
+import time
 from typing import AsyncGenerator, Union
-from services.models import History, KanbanBoards, Task, TaskPriority, Thread, new_run_id, role_order
+from services.models import History, KanbanBoards, Task, TaskPriority, Thread, new_run_id
 from setup import Registry
 from sqlalchemy.orm import Session
-from sqlalchemy import func, select
+from sqlalchemy import tuple_, update
 from pydantic import BaseModel
 from langchain_core.documents import Document
 from langchain_core.retrievers import BaseRetriever
@@ -15,6 +17,13 @@ from services.prompts import ps
 from util import get_session
 from mem0.memory.main import AsyncMemory
 from services.embed import embed_service
+from services.memory_writer import memory_writer
+from services.metrics import Trace, metrics
+from services.changes import DocumentKind
+from services.context import ContextAssembler
+from services.lexical import HybridRetriever, lexical_index
+from services.response_cache import ResponseCache
+from services.retrieval import RetrievalOrchestrator, RetrievalResult, RetrievalSource
 from langchain_core.tools import tool
 from services.kanban import CreateKanbanRequest, MoveKanbanRequest, UpdateKanbanRequest, kb_service
 
@@ -23,6 +32,10 @@ sys.path.append("..")
 
 logger = logging.getLogger(__name__)
 
+# Words per chunk when a cached answer is replayed
+REPLAY_WORDS = 4
+WORD = re.compile(r"\s*\S+\s*")
+
 
 class CreateThreadRequest(BaseModel):
     title: str
@@ -70,6 +83,45 @@ class ChatResponse(BaseModel):
     def from_chunk(chunk: AIMessage) -> 'ChatResponse':
         return ChatResponse(code=200, content=chunk.content)
 
+    @staticmethod
+    def from_cache(content: str) -> list['ChatResponse']:
+        """Split a cached answer into chunks, like a streamed one."""
+        words = WORD.findall(content)
+        return [ChatResponse(code=200, content="".join(words[i:i + REPLAY_WORDS]))
+                for i in range(0, len(words), REPLAY_WORDS)]
+
+    @staticmethod
+    def retrieving() -> 'ChatResponse':
+        return ChatResponse(code=102, content="retrieving")
+
+    @staticmethod
+    def from_partial(result: RetrievalResult) -> 'ChatResponse':
+        return ChatResponse(code=206, content=f"Context retrieved without: {', '.join(result.dropped)}")
+
+
+class HistoryPage:
+    def __init__(self, messages: list[History], next_cursor: Union[str, None]):
+        self.messages = messages
+        self.next_cursor = next_cursor
+
+    def to_dict(self) -> dict[str, any]:
+        return {
+            "messages": [m.to_dict() for m in self.messages],
+            "next_cursor": self.next_cursor,
+        }
+
+
+def history_cursor(history: History) -> str:
+    return f"{history.turn_id}:{history.role_rank}:{history.id}"
+
+
+def parse_history_cursor(cursor: str) -> tuple[int, int, int]:
+    try:
+        turn_id, rank, id = cursor.split(":")
+        return int(turn_id), int(rank), int(id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
 
 class MemZeroBridgeRetriever(BaseRetriever):
     memory: AsyncMemory
@@ -124,10 +176,26 @@ class ChatService():
         ]
         self.chat_model = registry.get_new_chat(self.tool_calls)
         self.memory = registry.get_memory()
-        self.notes_retriever = registry.get_notes_retriever(
-            collection=CollectionKey.NOTES_INDEXED)
-        self.tasks_retriever = registry.get_tasks_retriever(
-            collection=CollectionKey.TASKS_INDEXED)
+        self.notes_retriever = HybridRetriever(
+            vector=registry.get_notes_retriever(
+                collection=CollectionKey.NOTES_INDEXED),
+            index=lexical_index,
+            kind=DocumentKind.NOTE)
+        self.tasks_retriever = HybridRetriever(
+            vector=registry.get_tasks_retriever(
+                collection=CollectionKey.TASKS_INDEXED),
+            index=lexical_index,
+            kind=DocumentKind.TASK)
+        self.configs = registry.get_configs()
+        self.orchestrator = RetrievalOrchestrator(
+            budget=self.configs['retrieval'].getint('budget', 1500) / 1000)
+        self.speculative = self.configs['chat'].getboolean(
+            'speculative', False)
+        self.grace = self.configs['chat'].getint('graceWindow', 150) / 1000
+        self.history_turns = self.configs['chat'].getint('historyTurns', 6)
+        self.assembler = ContextAssembler.from_config(self.configs)
+        self.response_cache = ResponseCache.from_registry(registry) \
+            if self.configs['chat'].getboolean('responseCache', False) else None
 
     def create_thread(self, request: CreateThreadRequest) -> int:
         with get_session(self.registry) as session:
@@ -144,79 +212,139 @@ class ChatService():
         with get_session(self.registry) as session:
             return session.query(Thread).all()
 
-    async def send_message(self, request: ChatRequest) -> AsyncGenerator[ChatResponse, None]:
-        try:
-            run_id = 0
+    async def acreate_thread(self, request: CreateThreadRequest) -> int:
+        return await self.registry.run_db(self.create_thread, request)
 
-            with get_session(self.registry) as session:
-                thread = self._get_thread(session, request.id)
-                if thread is None:
-                    raise ValueError(f"Thread {request.id} does not exist")
-                logger.debug(f"Thread {request.id} found")
-                run_id = thread.run_id
+    async def aget_thread(self, thread_id: int) -> Thread:
+        return await self.registry.run_db(self.get_thread, thread_id)
 
-                turn_id = self._next_turn_id(session, request.id)
-                logger.debug(f"Turn ID: {turn_id}")
-                history = request.to_history(request.id, turn_id)
+    async def alist_threads(self) -> list[Thread]:
+        return await self.registry.run_db(self.list_threads)
 
-                session.add(history)
-                session.commit()
+    async def aget_messages(self, thread_id: int, limit: int, cursor: str = None) -> HistoryPage:
+        return await self.registry.run_db(self.get_messages, thread_id, limit, cursor)
+
+    async def send_message(self, request: ChatRequest) -> AsyncGenerator[ChatResponse, None]:
+        trace = Trace(metrics, "chat")
+        try:
+            run_id, turn_id, history = await self.registry.run_db(self._start_turn, request, trace)
 
             human = request.to_human()
-            mem_zero_retriever = MemZeroBridgeRetriever(
-                memory=self.memory, limit=20, run_id=run_id)
 
-            retrievers = [mem_zero_retriever,
-                          self.notes_retriever, self.tasks_retriever]
+            # Later turns also depend on the thread's history, the cache only
+            # keys answers on the question and the notes and tasks retrieved
+            cacheable = self.response_cache is not None and len(history) == 0
+            generation = None
+            if cacheable:
+                with trace.span("response_cache"):
+                    cached, generation = await self.response_cache.lookup(human.content)
+                if cached is not None:
+                    for response in ChatResponse.from_cache(cached):
+                        yield response
+                    await self.registry.run_db(self._finish_turn, request.id, turn_id, cached)
+                    return
 
-            combined = embed_service.combine_retriever(
-                retrievers,
-                filter=True,
-                reorder=True)
+            mem_zero_retriever = MemZeroBridgeRetriever(
+                memory=self.memory, limit=20, run_id=run_id)
 
-            vector_memory = await combined.ainvoke(input=human.content)
+            memory_source = RetrievalSource.from_config(
+                self.configs, "memory", mem_zero_retriever)
+            local_sources = [
+                RetrievalSource.from_config(
+                    self.configs, "notes", self.notes_retriever),
+                RetrievalSource.from_config(
+                    self.configs, "tasks", self.tasks_retriever),
+            ]
+
+            with trace.span("retrieval"):
+                if self.speculative:
+                    # Let the client show progress right away, and don't hold the
+                    # model back for mem0 longer than the grace window
+                    yield ChatResponse.retrieving()
+                    retrieved = await self.orchestrator.retrieve_speculative(
+                        human.content, local=local_sources, deferred=[memory_source], grace=self.grace, trace=trace)
+                else:
+                    retrieved = await self.orchestrator.retrieve(
+                        human.content, [memory_source, *local_sources], trace=trace)
+            if retrieved.is_partial():
+                yield ChatResponse.from_partial(retrieved)
+
+            with trace.span("redundancy_filter"):
+                # Keep relevance order, the context assembler cuts from the end
+                vector_memory = await embed_service.compress(
+                    retrieved.documents, human.content)
             logger.debug(f"Vector memory count: {len(vector_memory)}")
 
-            prompts = self._build_prompt(vector_memory, human.content)
+            with trace.span("prompt_build"):
+                prompts = self._build_prompt(vector_memory, history, human.content)
+            metrics.observe("chat_prompt_tokens", self.assembler.count_messages(prompts),
+                            "Tokens sent to the chat model per turn")
 
-            start = datetime.now()
+            start = time.perf_counter()
+            first_token = None
 
             response = []
             async for chunk in self.chat_model.astream(prompts):
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    trace.record("first_token", first_token - start)
                 logger.debug(f"Chunk: {chunk}")
                 response.append(chunk)
                 yield ChatResponse.from_chunk(chunk)
 
-            end = datetime.now()
-            logger.debug(f"Chat response returned after {end - start}ms")
+            end = time.perf_counter()
+            trace.record("stream", end - start)
+            if first_token is not None and end > first_token:
+                # Streamed chunks are roughly one token each
+                metrics.observe("chat_tokens_per_second", len(response) / (end - first_token),
+                                "Output tokens per second of chat responses")
+            logger.debug(f"Chat response returned after {end - start:.3f}s")
 
             content = "".join([m.content for m in response])
 
-            ai_history = History.build(content, request.id, turn_id)
+            await self.registry.run_db(self._finish_turn, request.id, turn_id, content)
 
-            with get_session(self.registry) as session:
-                session.add(ai_history)
-                self._set_last_updated(session, request.id)
-                session.commit()
+            # An answer built on partial context is not worth replaying
+            if cacheable and not retrieved.is_partial():
+                await self.response_cache.store(human.content, vector_memory, content, generation)
 
-            asyncio.create_task(self._add_memory(
-                thread_id=request.id, run_id=run_id, prompts=prompts, content=content))
+            # Earlier turns were already written to memory with their own turn
+            await memory_writer.submit(
+                run_id=run_id,
+                thread_id=request.id,
+                messages=[prompts[0], prompts[-1], {"role": "assistant", "content": content}])
         except ValueError as e:
             logger.error(f"ValueError in send_message: {e}")
             yield ChatResponse(code=404, content=str(e))
         except Exception as e:
             logger.error(f"Exception in send_message: {e}")
             yield ChatResponse(code=500, content="Internal server error.")
+        finally:
+            logger.info(f"Chat turn for thread {request.id}: {trace}")
 
-    async def _add_memory(self, thread_id: int, run_id: str, prompts: list[dict[str, any]], content: str):
-        start = datetime.now()
+    def _start_turn(self, request: ChatRequest, trace: Trace) -> tuple[str, int, list[dict[str, any]]]:
+        with get_session(self.registry) as session:
+            with trace.span("next_turn_id"):
+                turn = self._next_turn_id(session, request.id)
+            if turn is None:
+                raise ValueError(f"Thread {request.id} does not exist")
+            run_id, turn_id = turn
+            logger.debug(f"Turn ID: {turn_id}")
 
-        prompts.append({"role": "assistant", "content": content})
-        await self.memory.add(messages=prompts, run_id=run_id)
-        end = datetime.now()
+            with trace.span("history"):
+                history = self._recent_history(session, request.id, turn_id)
 
-        logger.debug(
-            f"Memory for thread {thread_id} added after {end - start}ms")
+            session.add(request.to_history(request.id, turn_id))
+            session.commit()
+            return run_id, turn_id, history
+
+    def _finish_turn(self, thread_id: int, turn_id: int, content: str):
+        ai_history = History.build(content, thread_id, turn_id)
+
+        with get_session(self.registry) as session:
+            session.add(ai_history)
+            self._set_last_updated(session, thread_id)
+            session.commit()
 
     def _set_last_updated(self, session: Session, thread_id: int):
         session.query(Thread) \
@@ -228,28 +356,72 @@ class ChatService():
             .filter(Thread.id == thread_id) \
             .first()
 
-    def _next_turn_id(self, session: Session, thread_id: int) -> int:
-        query = select((func.coalesce(func.max(History.turn_id), 0) + 1)) \
-            .where(History.thread_id == thread_id)
-
-        return session.execute(query).scalar_one()
+    def _next_turn_id(self, session: Session, thread_id: int) -> Union[tuple[str, int], None]:
+        """Claim the next turn of a thread, returns its run id and the turn id."""
+        query = update(Thread) \
+            .where(Thread.id == thread_id) \
+            .values(turn_count=Thread.turn_count + 1) \
+            .returning(Thread.run_id, Thread.turn_count)
+
+        row = session.execute(query).first()
+        return tuple(row) if row else None
+
+    def _recent_history(self, session: Session, thread_id: int, turn_id: int) -> list[dict[str, any]]:
+        """Messages of the `history_turns` turns before `turn_id`, oldest first."""
+        rows = session.query(History.role, History.content) \
+            .filter(History.thread_id == thread_id) \
+            .filter(History.turn_id >= turn_id - self.history_turns) \
+            .filter(History.turn_id < turn_id) \
+            .order_by(History.turn_id, History.role_rank, History.id) \
+            .all()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def _build_prompt(self, memory: list[Document], history: list[dict[str, any]], content: str) -> list[dict[str, any]]:
+        sections = ps.format_documents(memory)
+        # Newest turns first, so the oldest are the ones cut
+        sections["history"] = [m["content"] for m in reversed(history)]
+
+        reserved = self.assembler.count_messages([
+            {"role": "system", "content": ps.build_chat_system_prompt({})},
+            {"role": "user", "content": content},
+        ])
+        packed = self.assembler.pack(sections, reserved)
+
+        kept = packed.pop("history")
+        recent = [{"role": m["role"], "content": text}
+                  for m, text in zip(reversed(history), kept)]
 
-    def _build_prompt(self, memory: list[Document], content: str) -> list[dict[str, any]]:
-        sys_prompt = ps.build_chat_system_prompt(memory, content)
         return [
-            {"role": "system", "content": sys_prompt},
+            {"role": "system", "content": ps.build_chat_system_prompt(packed)},
+            *reversed(recent),
             {"role": "user", "content": content}
         ]
 
-    def get_messages(self, thread_id: int, page: int, limit: int) -> list[History]:
+    def get_messages(self, thread_id: int, limit: int, cursor: str = None) -> HistoryPage:
+        """
+        Newest messages first. `cursor` is the `next_cursor` of the previous
+        page, each page seeks straight to it on `ix_history_thread_turn_role`.
+        """
+        if limit < 1:
+            raise ValueError(f"Invalid limit: {limit}")
+
         with get_session(self.registry) as session:
-            return session.query(History) \
-                .filter(History.thread_id == thread_id) \
-                .order_by(History.turn_id.desc(), role_order().desc()) \
-                .offset((page - 1) * limit) \
-                .limit(limit) \
+            query = session.query(History) \
+                .filter(History.thread_id == thread_id)
+
+            if cursor:
+                query = query.filter(
+                    tuple_(History.turn_id, History.role_rank, History.id) < parse_history_cursor(cursor))
+
+            messages = query \
+                .order_by(History.turn_id.desc(), History.role_rank.desc(), History.id.desc()) \
+                .limit(limit + 1) \
                 .all()
 
+            if len(messages) > limit:
+                return HistoryPage(messages[:limit], history_cursor(messages[limit - 1]))
+            return HistoryPage(messages, None)
+
 
 @tool
 def get_close_to_due_date_tasks(days: int) -> list[Task]:
@@ -346,7 +518,7 @@ def update_task_priority(task_id: int, priority: int) -> Task:
         task_id=task_id,
         priority=priority)
 
-    return kb_service.update(request)
+    return kb_service.update(task_id, request)
 
 
 @tool
@@ -362,7 +534,7 @@ def update_task_due_date(task_id: int, days_from_now: int) -> Task:
     request = UpdateKanbanRequest(
         task_id=task_id,
         due_date=due_date)
-    return kb_service.update(request)
+    return kb_service.update(task_id, request)
 
 
 @tool
@@ -410,4 +582,4 @@ def update_task_description(task_id: int, description: str) -> Task:
         task_id=task_id,
         description=description)
 
-    return kb_service.update(request)
+    return kb_service.update(task_id, request)
@@ -64,6 +64,18 @@ class ConfigService():
                 session.delete(config)
             session.commit()
 
+    async def aget(self, key: str) -> Config:
+        return await self.registry.run_db(self.get, key)
+
+    async def aset(self, key: str, value: str):
+        return await self.registry.run_db(self.set, key, value)
+
+    async def alist(self) -> 'list[Config]':
+        return await self.registry.run_db(self.list)
+
+    async def aunset(self, key: str):
+        return await self.registry.run_db(self.unset, key)
+
 
 class ConfigKey:
     DEFAULT_AUDIO_DEVICE_NAME = "default_audio_device_name"
@@ -0,0 +1,107 @@
+from configparser import ConfigParser
+import logging
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Tokens a chat message costs on top of its content (role and separators)
+MESSAGE_OVERHEAD = 4
+
+# Below this, a truncated item carries too little to be worth including
+MIN_TRUNCATED_TOKENS = 32
+
+TRUNCATED = "..."
+
+
+class ApproximateEncoding:
+    """
+    Stand-in for a tiktoken encoding when its BPE files can't be loaded
+    (tiktoken downloads them on first use), about four characters a token.
+    """
+    name = "approximate"
+
+    def encode(self, text: str, disallowed_special=()) -> list[str]:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def decode(self, tokens: list[str]) -> str:
+        return "".join(tokens)
+
+
+class ContextAssembler:
+    """
+    Packs prompt sections into a fixed token budget.
+
+    Sections are filled in priority order and each section's items in the
+    order given, so the most important items come first. Items are taken
+    whole while they fit; the first one that doesn't is cut to the space
+    left, and the section ends there. Kept items are always a prefix of a
+    section's items, so callers can map them back to what they passed in.
+    """
+
+    def __init__(self, model: str, budget: int, priority: list[str]):
+        self.budget = budget
+        self.priority = priority
+        self.encoding = self._encoding(model)
+        logger.info(
+            f"Packing chat context into {budget} tokens ({self.encoding.name}), priority: {', '.join(priority)}")
+
+    def _encoding(self, model: str):
+        try:
+            try:
+                return tiktoken.encoding_for_model(model)
+            except KeyError:
+                return tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            logger.warning(f"Tokenizer for {model} unavailable, approximating token counts: {e}")
+            return ApproximateEncoding()
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, messages: list[dict[str, any]]) -> int:
+        return sum(self.count(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+    def truncate(self, text: str, tokens: int) -> str:
+        encoded = self.encoding.encode(text, disallowed_special=())
+        if len(encoded) <= tokens:
+            return text
+        return self.encoding.decode(encoded[:max(tokens - 1, 0)]) + TRUNCATED
+
+    def pack(self, sections: dict[str, list[str]], reserved: int) -> dict[str, list[str]]:
+        """
+        `reserved` is what the rest of the prompt (instructions, the user
+        message) already takes out of the budget.
+        """
+        remaining = self.budget - reserved
+        packed = {name: [] for name in sections}
+
+        for name in self._ordered(sections):
+            for item in sections[name]:
+                tokens = self.count(item) + MESSAGE_OVERHEAD
+                if tokens <= remaining:
+                    packed[name].append(item)
+                    remaining -= tokens
+                    continue
+
+                if remaining - MESSAGE_OVERHEAD >= MIN_TRUNCATED_TOKENS:
+                    packed[name].append(self.truncate(item, remaining - MESSAGE_OVERHEAD))
+                    remaining = 0
+                break
+
+            if len(packed[name]) < len(sections[name]):
+                logger.debug(
+                    f"Context section {name} cut to {len(packed[name])} of {len(sections[name])} items")
+
+        return packed
+
+    def _ordered(self, sections: dict[str, list[str]]) -> list[str]:
+        ranked = [name for name in self.priority if name in sections]
+        return ranked + [name for name in sections if name not in ranked]
+
+    @staticmethod
+    def from_config(configs: ConfigParser) -> 'ContextAssembler':
+        priority = configs['chat'].get('contextPriority', 'history,tasks,notes,memory')
+        return ContextAssembler(
+            model=configs['chat']['name'],
+            budget=configs['chat'].getint('contextBudget', 3000),
+            priority=[name.strip() for name in priority.split(',') if name.strip()])
@@ -0,0 +1,101 @@
+import asyncio
+import hashlib
+import logging
+import re
+from typing import Sequence
+import numpy as np
+from langchain_chroma import Chroma
+from langchain_core.documents import BaseDocumentTransformer, Document
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r"\w+")
+
+
+def simhash(text: str) -> int:
+    """64-bit SimHash of the words and word pairs of a text."""
+    words = WORD.findall(text.lower())
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if len(features) == 0:
+        return 0
+
+    hashes = np.array([
+        int.from_bytes(hashlib.blake2b(f.encode("utf-8"), digest_size=8).digest(), "little")
+        for f in features], dtype=np.uint64)
+    bits = np.unpackbits(hashes.view(np.uint8).reshape(-1, 8), axis=1, bitorder="little")
+    # A bit is set when most features set it
+    votes = bits.sum(axis=0) * 2 > len(features)
+    return int(np.packbits(votes, bitorder="little").view(np.uint64)[0])
+
+
+class RedundancyFilter(BaseDocumentTransformer):
+    """
+    Drops retrieved documents that are near duplicates of a better ranked one,
+    without calling the embeddings provider.
+
+    Documents that came out of a vector store are compared by the vectors
+    already stored there, by cosine similarity. Any pair where a document
+    has no stored vector (mem0 memories, full-text matches) is compared by
+    the Hamming distance of their SimHashes instead.
+    """
+
+    def __init__(self, stores: dict[str, Chroma], similarity: float, max_distance: int):
+        self.stores = stores
+        self.similarity = similarity
+        self.max_distance = max_distance
+
+    def transform_documents(self, documents: Sequence[Document], **kwargs) -> Sequence[Document]:
+        documents = list(documents)
+        if len(documents) < 2:
+            return documents
+
+        similar = self._similar(documents)
+        kept = []
+        for i in range(len(documents)):
+            if not similar[i, kept].any():
+                kept.append(i)
+
+        if len(kept) < len(documents):
+            logger.debug(
+                f"Dropped {len(documents) - len(kept)} redundant of {len(documents)} documents")
+        return [documents[i] for i in kept]
+
+    async def atransform_documents(self, documents: Sequence[Document], **kwargs) -> Sequence[Document]:
+        # Reading stored vectors is local, but blocking, Chroma I/O
+        return await asyncio.to_thread(self.transform_documents, documents)
+
+    def _similar(self, documents: list[Document]) -> np.ndarray:
+        n = len(documents)
+
+        hashes = np.array([simhash(d.page_content) for d in documents], dtype=np.uint64)
+        xor = hashes[:, None] ^ hashes[None, :]
+        distance = np.unpackbits(xor.view(np.uint8).reshape(n, n, 8), axis=2).sum(axis=2)
+        similar = distance <= self.max_distance
+
+        vectors = self._stored_vectors(documents)
+        has_vector = np.array([v is not None for v in vectors])
+        if has_vector.sum() > 1:
+            indexes = np.flatnonzero(has_vector)
+            matrix = np.array([vectors[i] for i in indexes], dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.where(norms > 0, norms, 1)
+            cosine = matrix @ matrix.T
+            similar[np.ix_(indexes, indexes)] = cosine >= self.similarity
+
+        return similar
+
+    def _stored_vectors(self, documents: list[Document]) -> list[np.ndarray]:
+        """Vectors of documents that carry a vector store id, None for the others."""
+        ids_by_type: dict[str, list[str]] = {}
+        for d in documents:
+            kind = d.metadata.get("type")
+            if d.id is not None and kind in self.stores:
+                ids_by_type.setdefault(kind, []).append(d.id)
+
+        found: dict[str, np.ndarray] = {}
+        for kind, ids in ids_by_type.items():
+            result = self.stores[kind]._collection.get(ids=ids, include=["embeddings"])
+            for id, vector in zip(result["ids"], result["embeddings"]):
+                found[id] = np.asarray(vector)
+
+        return [found.get(d.id) if d.id is not None else None for d in documents]
@@ -3,17 +3,26 @@ from langchain_text_splitters import RecursiveCharacterTextSplitter
 from setup import registry
 from langchain.retrievers.merger_retriever import MergerRetriever
 from langchain_core.retrievers import BaseRetriever
-from langchain_community.document_transformers import EmbeddingsRedundantFilter
+from langchain_core.documents import Document
 from langchain.retrievers.document_compressors.base import DocumentCompressorPipeline
 from langchain.retrievers.contextual_compression import ContextualCompressionRetriever
 from langchain_community.document_transformers import LongContextReorder
+from services.config import CollectionKey
+from services.dedup import RedundancyFilter
 
 
 class EmbedService():
     def __init__(self, registry: Registry):
         self.registry = registry
         self.model = registry.get_embeddings()
-        return
+        configs = registry.get_configs()
+        self.redundancy_filter = RedundancyFilter(
+            stores={
+                "note": registry.get_notes_vector_db(CollectionKey.NOTES_INDEXED),
+                "task": registry.get_tasks_vector_db(CollectionKey.TASKS_INDEXED),
+            },
+            similarity=configs['retrieval'].getfloat('redundancy', 0.95),
+            max_distance=configs['retrieval'].getint('simhashDistance', 3))
 
     def split_text(self, text: str) -> list[str]:
         splitter = RecursiveCharacterTextSplitter(
@@ -26,18 +35,27 @@ class EmbedService():
         lotr = MergerRetriever(retrievers=retrievers)
 
         if filter:
-            transformers = []
-            transformers.append(EmbeddingsRedundantFilter(embeddings=self.model))
-            if reorder:
-                transformers.append(LongContextReorder())
-            pipeline = DocumentCompressorPipeline(transformers=transformers)
             compresed_retriever = ContextualCompressionRetriever(
-                base_compressor=pipeline,
+                base_compressor=self._pipeline(reorder),
                 base_retriever=lotr
             )
             return compresed_retriever
 
         return lotr
 
+    async def compress(self, documents: list[Document], query: str, reorder: bool = False) -> list[Document]:
+        """Apply the redundancy filter (and reordering) to already retrieved documents."""
+        if len(documents) == 0:
+            return documents
+        docs = await self._pipeline(reorder).acompress_documents(documents, query)
+        return list(docs)
+
+    def _pipeline(self, reorder: bool) -> DocumentCompressorPipeline:
+        transformers = []
+        transformers.append(self.redundancy_filter)
+        if reorder:
+            transformers.append(LongContextReorder())
+        return DocumentCompressorPipeline(transformers=transformers)
+
 
 embed_service = EmbedService(registry)
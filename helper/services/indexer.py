@@ -1,9 +1,14 @@
 import asyncio
+import hashlib
 import threading
+import time
 from typing import Callable
+from services.batcher import EmbeddingBatcher, PendingChunk
+from services.changes import ChangeBatch, DocumentKind, change_feed
 from services.kanban import TaskMetadata
 from services.config import CollectionKey
 from services.embed import embed_service
+from services.lexical import lexical_index
 from services.models import KanbanBoards, Note, Task, TaskPriority
 from services.notes import DocumentMetadata
 from setup import Registry
@@ -12,6 +17,49 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def chunk_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ChunkDiff:
+    """
+    Difference between the chunks a document is indexed with and the chunks
+    its current content splits into. Unchanged chunks keep their vectors,
+    only added chunks are embedded and only removed chunks are deleted.
+    """
+
+    def __init__(self, store, parts: list[str], metadata: dict[str, any], vector_ids: list[str], hashes: list[str]):
+        self.metadata = metadata
+        self.chunks: list[PendingChunk] = []
+        self.kept: list[str] = []
+        self.vector_ids: list[str] = []
+        self.hashes: list[str] = []
+
+        old: dict[str, list[str]] = {}
+        # Rows indexed before chunk hashes existed can't be matched
+        if len(hashes) == len(vector_ids):
+            for h, id in zip(hashes, vector_ids):
+                old.setdefault(h, []).append(id)
+            self.stale: list[str] = []
+        else:
+            self.stale = list(vector_ids)
+
+        for part in parts:
+            h = chunk_hash(part)
+            if len(old.get(h, [])) > 0:
+                id = old[h].pop(0)
+                self.kept.append(id)
+            else:
+                chunk = PendingChunk(store, part, metadata)
+                self.chunks.append(chunk)
+                id = chunk.id
+            self.vector_ids.append(id)
+            self.hashes.append(h)
+
+        for ids in old.values():
+            self.stale.extend(ids)
+
+
 class DocumentIndexer:
     def __init__(self, registry: Registry):
         self.registry = registry
@@ -20,6 +68,16 @@ class DocumentIndexer:
             CollectionKey.NOTES_INDEXED)
         self.tasks_vect = registry.get_tasks_vector_db(
             CollectionKey.TASKS_INDEXED)
+        self.changes = change_feed
+        self.lexical = lexical_index
+        configs = registry.get_configs()
+        self.debounce = configs['indexer'].getint('debounce', 250) / 1000
+        self.reconcile_interval = configs['indexer'].getint('reconcile', 300)
+        self.batcher = EmbeddingBatcher(
+            embeddings=registry.get_embeddings(),
+            max_items=configs['embeddings'].getint('batchSize', 256),
+            max_tokens=configs['embeddings'].getint('batchTokens', 8000),
+            concurrency=configs['embeddings'].getint('concurrency', 2))
         self._is_cancel = False
         return
 
@@ -32,71 +90,103 @@ class DocumentIndexer:
         asyncio.run(self._run_loop(is_cancel))
 
     async def _run_loop(self, is_cancel: Callable[[], bool]):
-        while True:
+        last_reconcile = None
+
+        while not is_cancel():
             try:
+                now = time.monotonic()
+                if last_reconcile is None or now - last_reconcile >= self.reconcile_interval:
+                    await self._reconcile()
+                    last_reconcile = time.monotonic()
+                    continue
+
+                timeout = self.reconcile_interval - (now - last_reconcile)
+                has_changes = await asyncio.to_thread(self.changes.wait, timeout)
                 if is_cancel():
                     break
+                if not has_changes:
+                    continue
 
-                await self._fetch_need_delete_notes()
-                await self._fetch_need_index_notes()
-
-                await self._fetch_need_delete_tasks()
-                await self._fetch_need_index_tasks()
-
-                if is_cancel():
-                    break
+                # Let bursts of writes (e.g. typing in a note) settle into a single pass
+                await asyncio.sleep(self.debounce)
+                batch = self.changes.drain()
+                if batch.is_empty():
+                    continue
 
-                await asyncio.sleep(10)
+                logger.debug(f"Processing {batch}")
+                await self._process(batch)
             except Exception as e:
                 logger.error(f"Error in _run_loop: {e}", exc_info=True)
-                await asyncio.sleep(10)
+                await asyncio.sleep(self.debounce)
 
-    async def _fetch_need_index_notes(self):
-        notes = self._find_dirty_notes()
-        if len(notes) == 0:
-            logger.debug("No dirty notes to index")
-            return
+    async def _reconcile(self):
+        """
+        Full sweep over dirty and removed rows, a safety net for changes
+        that never made it to the change feed (e.g. written before a restart).
+        """
+        logger.debug("Reconciling document index")
 
-        vector_ids = []
-        for note in notes:
-            vector_ids.extend(note.vector_ids)
+        await self._fetch_need_delete_notes()
+        await self._fetch_need_delete_tasks()
 
-        if len(vector_ids) > 0:
-            self._clean_dirty_notes(vector_ids=vector_ids)
+        await self._index(self._find_dirty_notes(), self._find_dirty_tasks())
+
+    async def _process(self, batch: ChangeBatch):
+        notes = []
+        tasks = []
 
-        tasks = [self._index_note(note) for note in notes]
-        if tasks:
-            await asyncio.gather(*tasks)
+        if len(batch.notes) > 0:
+            await self._fetch_need_delete_notes(ids=batch.notes)
+            notes = self._find_dirty_notes(ids=batch.notes)
 
-        self._set_completed(notes)
+        if len(batch.tasks) > 0:
+            await self._fetch_need_delete_tasks(ids=batch.tasks)
+            tasks = self._find_dirty_tasks(ids=batch.tasks)
 
-    async def _fetch_need_index_tasks(self):
-        tasks = self._find_dirty_tasks()
-        if len(tasks) == 0:
-            logger.debug("No dirty tasks to index")
+        await self._index(notes, tasks)
+
+    async def _index(self, notes: list[Note], tasks: list[Task]):
+        """
+        Re-index notes and tasks in a single embedding pass, so chunks from
+        every document share the same size-bounded provider requests.
+        """
+        if len(notes) == 0 and len(tasks) == 0:
+            logger.debug("No dirty notes or tasks to index")
             return
 
-        vector_ids = []
-        for task in tasks:
-            vector_ids.extend(task.vector_ids)
+        note_diffs = [self._index_note(note) for note in notes]
+        task_diffs = [self._index_task(task) for task in tasks]
 
-        if len(vector_ids) > 0:
-            self._clean_dirty_tasks(vector_ids=vector_ids)
+        stale = [id for d in note_diffs for id in d.stale]
+        if len(stale) > 0:
+            self._clean_dirty_notes(vector_ids=stale)
+
+        stale = [id for d in task_diffs for id in d.stale]
+        if len(stale) > 0:
+            self._clean_dirty_tasks(vector_ids=stale)
+
+        # Metadata (title, board, priority...) may have changed even when the
+        # text did not, refreshing it is a local write and needs no embedding
+        self._refresh_metadata(self.notes_vect, note_diffs)
+        self._refresh_metadata(self.tasks_vect, task_diffs)
 
-        routines = [self._index_task(task) for task in tasks]
-        if routines:
-            await asyncio.gather(*routines)
+        chunks = [c for d in note_diffs + task_diffs for c in d.chunks]
+        await self.batcher.run(chunks)
+        logger.info(
+            f"Indexed {len(notes)} notes and {len(tasks)} tasks with {len(chunks)} new parts")
 
-        self._set_completed(tasks)
+        self._set_completed(notes, tasks)
 
-    async def _fetch_need_delete_notes(self):
+    async def _fetch_need_delete_notes(self, ids: set[int] = None):
         vector_ids = []
         note_ids = []
 
         with self.registry.get_session() as session:
-            notes = session.query(Note) \
-                .filter(Note.for_removal == True) \
-                .all()
+            query = session.query(Note) \
+                .filter(Note.for_removal == True)
+            if ids is not None:
+                query = query.filter(Note.id.in_(ids))
+            notes = query.all()
 
             if len(notes) == 0:
                 logger.debug("No dirty notes to delete")
@@ -109,20 +199,23 @@ class DocumentIndexer:
             session.query(Note) \
                 .filter(Note.id.in_(note_ids)) \
                 .delete(synchronize_session=False)
+            self.lexical.remove(session, DocumentKind.NOTE, note_ids)
 
             session.commit()
 
         if len(vector_ids) > 0:
             self._clean_dirty_notes(vector_ids=vector_ids)
 
-    async def _fetch_need_delete_tasks(self):
+    async def _fetch_need_delete_tasks(self, ids: set[int] = None):
         vector_ids = []
         task_ids = []
 
         with self.registry.get_session() as session:
-            tasks = session.query(Task) \
-                .filter(Task.for_removal == True) \
-                .all()
+            query = session.query(Task) \
+                .filter(Task.for_removal == True)
+            if ids is not None:
+                query = query.filter(Task.id.in_(ids))
+            tasks = query.all()
 
             if len(tasks) == 0:
                 logger.debug("No dirty tasks to delete")
@@ -135,6 +228,7 @@ class DocumentIndexer:
             session.query(Task) \
                 .filter(Task.id.in_(task_ids)) \
                 .delete(synchronize_session=False)
+            self.lexical.remove(session, DocumentKind.TASK, task_ids)
 
             session.commit()
 
@@ -147,55 +241,82 @@ class DocumentIndexer:
     def _clean_dirty_tasks(self, vector_ids: list[str]):
         self.tasks_vect.delete(ids=vector_ids)
 
-    def _find_dirty_notes(self):
+    def _find_dirty_notes(self, ids: set[int] = None):
         with self.registry.get_session() as session:
-            return session.query(Note) \
-                .filter(Note.is_dirty == True) \
-                .all()
-
-    def _find_dirty_tasks(self):
+            query = session.query(Note) \
+                .filter(Note.for_removal == False)
+            # Published ids are re-indexed even if a previous pass already
+            # cleared their flag, so a write racing with indexing is not lost
+            if ids is not None:
+                query = query.filter(Note.id.in_(ids))
+            else:
+                query = query.filter(Note.is_dirty == True)
+            return query.all()
+
+    def _find_dirty_tasks(self, ids: set[int] = None):
         with self.registry.get_session() as session:
-            return session.query(Task) \
-                .filter(Task.is_dirty == True) \
-                .all()
-
-    async def _index_note(self, note: Note) -> list[str]:
+            query = session.query(Task) \
+                .filter(Task.for_removal == False)
+            if ids is not None:
+                query = query.filter(Task.id.in_(ids))
+            else:
+                query = query.filter(Task.is_dirty == True)
+            return query.all()
+
+    def _index_note(self, note: Note) -> ChunkDiff:
         logger.debug(f"Indexing note {note.id}")
 
         parts = embed_service.split_text(text=note.content)
-        meta = DocumentMetadata.from_model(note=note)
+        meta = DocumentMetadata.from_model(note=note).to_dict()
 
-        ids = await self.notes_vect.aadd_texts(texts=parts, metadatas=[meta.to_dict()])
-        logger.info(f"Indexed note {note.id} with {len(ids)} parts")
+        diff = ChunkDiff(self.notes_vect, parts, meta,
+                         note.vector_ids, note.chunk_hashes)
 
-        note.vector_ids = ids
-        return ids
+        note.vector_ids = diff.vector_ids
+        note.chunk_hashes = diff.hashes
+        return diff
 
-    async def _index_task(self, task: Task):
+    def _index_task(self, task: Task) -> ChunkDiff:
         logger.debug(f"Indexing task {task.id}")
 
-        title_parts = embed_service.split_text(text=task.title)
-        description_parts = embed_service.split_text(text=task.description)
+        parts = embed_service.split_text(text=task.title)
+        parts.extend(embed_service.split_text(text=task.description))
 
-        meta = TaskMetadata.from_model(task)
+        meta = TaskMetadata.from_model(task).to_dict()
 
-        vector_ids = []
-        vector_ids.extend(await self.tasks_vect.aadd_texts(texts=title_parts, metadatas=[meta.to_dict()]))
-        vector_ids.extend(await self.tasks_vect.aadd_texts(texts=description_parts, metadatas=[meta.to_dict()]))
+        diff = ChunkDiff(self.tasks_vect, parts, meta,
+                         task.vector_ids, task.chunk_hashes)
 
-        task.vector_ids = vector_ids
-        return vector_ids
+        task.vector_ids = diff.vector_ids
+        task.chunk_hashes = diff.hashes
+        return diff
 
-    def _set_completed(self, notes: list[Note]):
+    def _refresh_metadata(self, store, diffs: list[ChunkDiff]):
+        ids = []
+        metadatas = []
+        for d in diffs:
+            if len(d.kept) == 0:
+                continue
+            ids.extend(d.kept)
+            metadatas.extend([d.metadata] * len(d.kept))
+
+        if len(ids) > 0:
+            store._collection.update(ids=ids, metadatas=metadatas)
+
+    def _set_completed(self, notes: list[Note], tasks: list[Task]):
         with self.registry.get_session() as session:
-            for note in notes:
-                note.is_dirty = False
-                session.add(note)
+            for document in notes + tasks:
+                document.is_dirty = False
+                session.add(document)
+            # The full-text index follows the same documents as the vector stores
+            self.lexical.upsert_notes(session, notes)
+            self.lexical.upsert_tasks(session, tasks)
             session.commit()
 
     def stop(self):
         if self._thread is not None:
             self._is_cancel = True
+            self.changes.wake()
 
             self._thread.join()
             self._thread = None
@@ -1,18 +1,24 @@
-from collections import defaultdict
 from datetime import datetime, timedelta
 import logging
 from typing import Union
 
 from pydantic import BaseModel
 from setup import Registry
+from services.changes import DocumentKind, change_feed
 from services.models import KanbanBoards, Task, TaskPriority
+from services.ordering import TaskOrdering
 from sqlalchemy.orm import Session
+from sqlalchemy import func, select, tuple_
 from setup import registry
 from util import end_of_this_week, end_of_this_month, datetime_from
 
 logger = logging.getLogger(__name__)
 
 
+class InvalidMoveError(ValueError):
+    """A move whose neighbors don't match the current board order."""
+
+
 class CreateKanbanRequest(BaseModel):
     title: str
     description: str
@@ -46,13 +52,40 @@ class UpdateKanbanRequest(BaseModel):
 class MoveKanbanRequest(BaseModel):
     task_id: int
     board: KanbanBoards
-    before_task_id: Union[int, None]
-    after_task_id: Union[int, None]
+    # Task that ends up right above the moved task, None for the top of the board
+    before_task_id: Union[int, None] = None
+    # Task that ends up right below the moved task, None for the bottom of the board
+    after_task_id: Union[int, None] = None
 
     def update_model(self, task: Task):
         task.board = KanbanBoards(self.board).value
 
 
+class TaskSummary(BaseModel):
+    id: int
+    title: str
+    board: str
+    priority: int
+    due_date: Union[datetime, None]
+    position: int
+
+    def cursor(self) -> str:
+        return f"{self.position}:{self.id}"
+
+
+class BoardPage(BaseModel):
+    tasks: list[TaskSummary]
+    next_cursor: Union[str, None]
+
+
+def parse_cursor(cursor: str) -> tuple[int, int]:
+    try:
+        position, id = cursor.split(":")
+        return int(position), int(id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
 class KanbanService():
     def __init__(self, registry: Registry):
         self.registry = registry
@@ -64,11 +97,20 @@ class KanbanService():
 
             last_task = self._last_task(session, task.board)
 
-            task.insert_between(before=last_task)
+            TaskOrdering(session).place(task, before=last_task)
 
             session.add(task)
             session.commit()
-            return task.id
+
+        change_feed.publish(DocumentKind.TASK, task.id)
+        return task.id
+
+    def get(self, task_id: int) -> Task:
+        with self.registry.get_session() as session:
+            task = self._get_task(session, task_id)
+            if not task:
+                raise ValueError(f"Task {task_id} not found")
+            return task
 
     def _get_task(self, session: Session, task_id: int) -> Task:
         return session.query(Task) \
@@ -76,40 +118,53 @@ class KanbanService():
             .filter(Task.for_removal == False) \
             .first()
 
-    def _last_task(self, session: Session, board: str) -> Task:
-        return session.query(Task) \
+    def _last_task(self, session: Session, board: str, exclude_id: int = None) -> Task:
+        query = session.query(Task) \
             .filter(Task.board == board) \
-            .filter(Task.for_removal == False) \
-            .order_by(Task.position.desc()) \
-            .first()
+            .filter(Task.for_removal == False)
+        if exclude_id is not None:
+            query = query.filter(Task.id != exclude_id)
+        return query.order_by(Task.position.desc()).first()
 
-    def _before_task(self, session: Session, board: str, task_id: int) -> Task:
+    def _previous_task(self, session: Session, board: str, position: int, exclude_id: int) -> Task:
         return session.query(Task) \
             .filter(Task.board == board) \
-            .filter(Task.id < task_id) \
+            .filter(Task.position < position) \
+            .filter(Task.id != exclude_id) \
             .filter(Task.for_removal == False) \
             .order_by(Task.position.desc()) \
             .first()
 
-    def _after_task(self, session: Session, board: str, task_id: int) -> Task:
+    def _next_task(self, session: Session, board: str, position: int, exclude_id: int) -> Task:
         return session.query(Task) \
             .filter(Task.board == board) \
-            .filter(Task.id > task_id) \
+            .filter(Task.position > position) \
+            .filter(Task.id != exclude_id) \
             .filter(Task.for_removal == False) \
             .order_by(Task.position.asc()) \
             .first()
 
-    def update(self, req: UpdateKanbanRequest):
+    def _neighbor(self, session: Session, board: str, task_id: int) -> Task:
+        if task_id is None:
+            return None
+        task = self._get_task(session, task_id)
+        if not task or task.board != board:
+            raise ValueError(f"Task {task_id} not found on board {board}")
+        return task
+
+    def update(self, task_id: int, req: UpdateKanbanRequest):
         with self.registry.get_session() as session:
-            task = self._get_task(session, req.task_id)
+            task = self._get_task(session, task_id)
             if not task:
-                raise ValueError(f"Task {req.task_id} not found")
+                raise ValueError(f"Task {task_id} not found")
 
             req.update_model(task)
             task.is_dirty = True
 
             session.commit()
 
+        change_feed.publish(DocumentKind.TASK, task_id)
+
     def move(self, req: MoveKanbanRequest):
         with self.registry.get_session() as session:
             task = self._get_task(session, req.task_id)
@@ -118,86 +173,150 @@ class KanbanService():
 
             req.update_model(task)
 
-            before = self._before_task(session, req.board, task.id)
-            after = self._after_task(session, req.board, task.id)
-            task.insert_between(before=before, after=after)
+            if task.id in (req.before_task_id, req.after_task_id):
+                raise InvalidMoveError(f"Task {task.id} can't be placed next to itself")
+
+            before = self._neighbor(session, task.board, req.before_task_id)
+            after = self._neighbor(session, task.board, req.after_task_id)
+
+            # Fill in the side the client left out from the current order
+            if before and after:
+                # A stale board would make place() rebalance the wrong window
+                following = self._next_task(
+                    session, task.board, before.position, task.id)
+                if before.position >= after.position or following is None or following.id != after.id:
+                    raise InvalidMoveError(
+                        f"Tasks {before.id} and {after.id} are not adjacent on board {task.board}")
+            elif before and not after:
+                after = self._next_task(
+                    session, task.board, before.position, task.id)
+            elif after and not before:
+                before = self._previous_task(
+                    session, task.board, after.position, task.id)
+            elif not before and not after:
+                before = self._last_task(session, task.board, task.id)
+
+            TaskOrdering(session).place(task, before=before, after=after)
+            task.is_dirty = True
 
             session.commit()
 
+        # The board is part of the indexed task and of cached chat answers
+        change_feed.publish(DocumentKind.TASK, task.id)
+
     def delete(self, task_id: int):
         with self.registry.get_session() as session:
             task = self._get_task(session, task_id)
             if not task:
                 raise ValueError(f"Task {task_id} not found")
 
-            self._delete_task(session, task)
+            self._delete_task(session, task.id)
 
             session.commit()
 
+        change_feed.publish(DocumentKind.TASK, task_id)
+
     def _delete_task(self, session: Session, task_id: int):
         session.query(Task) \
             .filter(Task.id == task_id) \
             .update({"for_removal": True})
 
-    def list_by_board(self) -> list[Task]:
-        boards = [KanbanBoards.TO_DO, KanbanBoards.IN_PROGRESS,
-                  KanbanBoards.IN_REVIEW, KanbanBoards.DONE]
-        tasks = defaultdict(list)
+    def list_by_board(self, limit: int = 50, board: str = None, cursor: str = None) -> dict[str, BoardPage]:
+        """
+        First `limit` tasks of every board (or the page of `board` after
+        `cursor`) in a single query, without descriptions. Full tasks are
+        loaded one at a time through `get`.
+        """
+        if limit < 1:
+            raise ValueError(f"Invalid limit: {limit}")
+
+        ranked = select(
+            Task.id, Task.title, Task.board, Task.priority, Task.due_date, Task.position,
+            func.row_number().over(
+                partition_by=Task.board,
+                order_by=(Task.position.asc(), Task.id.asc())).label("rank")) \
+            .where(Task.for_removal == False)
+
+        if board is not None:
+            ranked = ranked.where(Task.board == KanbanBoards(board).value)
+            if cursor is not None:
+                ranked = ranked.where(
+                    tuple_(Task.position, Task.id) > parse_cursor(cursor))
+
+        ranked = ranked.subquery()
+        # Rows are bucketed and ordered per board below, sorting them in
+        # SQL would need a temporary b-tree over the window output
+        query = select(ranked) \
+            .where(ranked.c.rank <= limit + 1)
+
+        boards = [board] if board is not None else [b.value for b in KanbanBoards]
+        tasks: dict[str, list[TaskSummary]] = {b: [] for b in boards}
         with self.registry.get_session() as session:
-            for board in boards:
-                tasks[board] = session.query(Task) \
-                    .filter(Task.board == board.value) \
-                    .filter(Task.for_removal == False) \
-                    .order_by(Task.position.asc()) \
-                    .all()
-        return tasks
+            for row in sorted(session.execute(query), key=lambda r: r.rank):
+                tasks[row.board].append(TaskSummary(
+                    id=row.id,
+                    title=row.title,
+                    board=row.board,
+                    priority=row.priority,
+                    due_date=row.due_date,
+                    position=row.position))
+
+        pages = {}
+        for b, rows in tasks.items():
+            # The extra row only tells whether there is a next page
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            pages[b] = BoardPage(
+                tasks=rows,
+                next_cursor=rows[-1].cursor() if has_more else None)
+        return pages
 
     def list_by_duedate_within(self, days: int) -> list[Task]:
-        with self.registry.get_session() as session:
-            return session.query(Task) \
-                .filter(Task.due_date.between(datetime.now(), datetime.now() + timedelta(days=days))) \
-                .filter(Task.for_removal == False) \
-                .order_by(Task.due_date.asc(), Task.priority.desc(), Task.created_at.desc()) \
-                .all()
+        now = datetime.now()
+        return self._list_by_duedate_between(now, now + timedelta(days=days))
 
     def list_by_duedate_today(self) -> list[Task]:
-        end = datetime_from(datetime.now(), days=1)
-
-        with self.registry.get_session() as session:
-            return session.query(Task) \
-                .filter(Task.due_date.between(datetime.now(), end)) \
-                .filter(Task.for_removal == False) \
-                .order_by(Task.due_date.asc(), Task.priority.desc(), Task.created_at.desc()) \
-                .all()
+        now = datetime.now()
+        return self._list_by_duedate_between(now, datetime_from(now, days=1))
 
     def list_by_duedate_tomorrow(self) -> list[Task]:
-        end = datetime_from(datetime.now(),  days=1)
-
-        with self.registry.get_session() as session:
-            return session.query(Task) \
-                .filter(Task.due_date.between(datetime.now(), end)) \
-                .filter(Task.for_removal == False) \
-                .order_by(Task.due_date.asc(), Task.priority.desc(), Task.created_at.desc()) \
-                .all()
+        now = datetime.now()
+        return self._list_by_duedate_between(datetime_from(now, days=1), datetime_from(now, days=2))
 
     def list_by_duedate_this_week(self) -> list[Task]:
-        end = end_of_this_week(datetime.now())
+        now = datetime.now()
+        return self._list_by_duedate_between(now, end_of_this_week(now))
+
+    def list_by_duedate_this_month(self) -> list[Task]:
+        now = datetime.now()
+        return self._list_by_duedate_between(now, end_of_this_month(now))
 
+    def _list_by_duedate_between(self, start: datetime, end: datetime) -> list[Task]:
+        # Served by the partial index ix_tasks_due_date_active
         with self.registry.get_session() as session:
             return session.query(Task) \
-                .filter(Task.due_date.between(datetime.now(), end)) \
+                .filter(Task.due_date.between(start, end)) \
                 .filter(Task.for_removal == False) \
                 .order_by(Task.due_date.asc(), Task.priority.desc(), Task.created_at.desc()) \
                 .all()
 
-    def list_by_duedate_this_month(self) -> list[Task]:
-        end = end_of_this_month(datetime.now())
+    async def acreate(self, request: CreateKanbanRequest) -> int:
+        return await self.registry.run_db(self.create, request)
 
-        with self.registry.get_session() as session:
-            return session.query(Task) \
-                .filter(Task.due_date.between(datetime.now(), end)) \
-                .filter(Task.for_removal == False) \
+    async def aget(self, task_id: int) -> Task:
+        return await self.registry.run_db(self.get, task_id)
+
+    async def aupdate(self, task_id: int, req: UpdateKanbanRequest):
+        return await self.registry.run_db(self.update, task_id, req)
+
+    async def amove(self, req: MoveKanbanRequest):
+        return await self.registry.run_db(self.move, req)
+
+    async def adelete(self, task_id: int):
+        return await self.registry.run_db(self.delete, task_id)
 
+    async def alist_by_board(self, limit: int = 50, board: str = None, cursor: str = None) -> dict[str, BoardPage]:
+        return await self.registry.run_db(self.list_by_board, limit, board, cursor)
 
 
 class TaskMetadata(BaseModel):
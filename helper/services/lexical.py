@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import re
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from sqlalchemy import Column, Integer, MetaData, Table, Text, delete, insert, text
+from sqlalchemy.orm import Session
+from services.changes import DocumentKind
+from services.kanban import TaskMetadata
+from services.models import Note, Task
+from services.notes import DocumentMetadata
+from setup import Registry, registry
+
+logger = logging.getLogger(__name__)
+
+# Constant of reciprocal rank fusion, dampens the weight of the top ranks
+RRF_K = 60
+
+# Tokens around the best match returned as a document's content
+SNIPPET_TOKENS = 32
+
+# FTS5 tables created by services/migrations.py, not by `create_all`. Writes
+# go through Core statements so RoutingSession sends them to the writer.
+fts_metadata = MetaData()
+notes_fts = Table("notes_fts", fts_metadata,
+                  Column("rowid", Integer, primary_key=True),
+                  Column("title", Text),
+                  Column("content", Text))
+tasks_fts = Table("tasks_fts", fts_metadata,
+                  Column("rowid", Integer, primary_key=True),
+                  Column("title", Text),
+                  Column("description", Text))
+
+TASK_ID = re.compile(r"^#?(\d+)$")
+
+# snake_case, dotted.names, camelCase, kebab-case, error codes (E1234, HTTP-404) and ids (#42)
+IDENTIFIER = re.compile(
+    r"^(\w+[_.]\w[\w.]*|[a-z]+[A-Z]\w*|\w+-\w[\w-]*|[A-Za-z]{1,6}-?\d+|#?\d+)$")
+
+# Queries with more words than this are questions, not lookups
+MAX_LOOKUP_WORDS = 3
+
+
+def match_query(query: str) -> str:
+    """
+    FTS5 query matching any of the query's words. Every word is quoted, so
+    punctuation in identifiers is matched as a phrase instead of parsed as
+    FTS5 syntax.
+    """
+    words = [w.strip(",;:?!()[]{}'\"") for w in query.split()]
+    return " OR ".join('"' + w.replace('"', '""') + '"' for w in words if w)
+
+
+def identifiers(query: str) -> list[str]:
+    """Words of the query that look like identifiers."""
+    words = [w.strip(",;:?!()") for w in query.split()]
+    return [w for w in words if IDENTIFIER.match(w)]
+
+
+def is_lookup(query: str) -> bool:
+    return 0 < len(query.split()) <= MAX_LOOKUP_WORDS and len(identifiers(query)) > 0
+
+
+def rrf_fuse(rankings: list[list[Document]], limit: int, k: int = RRF_K) -> list[Document]:
+    """
+    Reciprocal rank fusion of ranked document lists, keeping `limit` documents.
+
+    Documents are identified by their type and id, so several chunks of one
+    note count as one document, ranked at its best chunk. The first ranking
+    gives a document its content, all of its chunks kept together; a
+    document missing from it is represented by its first match elsewhere.
+    """
+    scores: dict[tuple, float] = {}
+    chunks: dict[tuple, list[Document]] = {}
+
+    for i, ranking in enumerate(rankings):
+        seen = set()
+        for rank, doc in enumerate(ranking):
+            key = (doc.metadata.get("type"), doc.metadata.get("id"))
+            if key not in seen:
+                seen.add(key)
+                scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+            if i == 0:
+                chunks.setdefault(key, []).append(doc)
+            elif key not in chunks:
+                chunks[key] = [doc]
+
+    ordered = sorted(scores, key=lambda key: scores[key], reverse=True)[:limit]
+    return [doc for key in ordered for doc in chunks[key]]
+
+
+class LexicalIndex:
+    """
+    Full-text index of notes (title, content) and tasks (title, description)
+    in SQLite FTS5 tables keyed by the row id, ranked with BM25.
+
+    The indexer keeps it in sync with the vector stores; searching it needs
+    no embedding call.
+    """
+
+    def __init__(self, registry: Registry):
+        self.registry = registry
+
+    def upsert_notes(self, session: Session, notes: list[Note]):
+        self.remove(session, DocumentKind.NOTE, [n.id for n in notes])
+        if len(notes) > 0:
+            session.execute(insert(notes_fts), [
+                {"rowid": n.id, "title": n.title, "content": n.content} for n in notes])
+
+    def upsert_tasks(self, session: Session, tasks: list[Task]):
+        self.remove(session, DocumentKind.TASK, [t.id for t in tasks])
+        if len(tasks) > 0:
+            session.execute(insert(tasks_fts), [
+                {"rowid": t.id, "title": t.title, "description": t.description} for t in tasks])
+
+    def remove(self, session: Session, kind: DocumentKind, ids: list[int]):
+        if len(ids) == 0:
+            return
+        table = notes_fts if kind == DocumentKind.NOTE else tasks_fts
+        session.execute(delete(table).where(table.c.rowid.in_(list(ids))))
+
+    def search(self, kind: DocumentKind, query: str, limit: int) -> list[Document]:
+        match = match_query(query)
+        if len(match) == 0:
+            return []
+
+        with self.registry.get_session() as session:
+            if kind == DocumentKind.NOTE:
+                return self._search_notes(session, match, limit)
+            return self._search_tasks(session, query, match, limit)
+
+    async def asearch(self, kind: DocumentKind, query: str, limit: int) -> list[Document]:
+        return await self.registry.run_db(self.search, kind, query, limit)
+
+    def _match(self, session: Session, table: str, match: str, limit: int) -> list[tuple[int, str]]:
+        # Ranked by FTS5 alone, joining the source table here would force a sort
+        return session.execute(text(f"""
+            SELECT rowid, snippet({table}, -1, '', '', '...', {SNIPPET_TOKENS})
+            FROM {table}
+            WHERE {table} MATCH :match
+            ORDER BY rank
+            LIMIT :limit"""), {"match": match, "limit": limit}).all()
+
+    def _search_notes(self, session: Session, match: str, limit: int) -> list[Document]:
+        snippets = dict(self._match(session, "notes_fts", match, limit))
+        if len(snippets) == 0:
+            return []
+
+        notes = {id: (title, created_at) for id, title, created_at in session.query(Note.id, Note.title, Note.created_at)
+                 .filter(Note.id.in_(snippets.keys()))
+                 .filter(Note.for_removal == False)}
+
+        return [Document(
+            page_content=snippet,
+            metadata=DocumentMetadata(id=id, title=notes[id][0], created_at=notes[id][1]).to_dict())
+            for id, snippet in snippets.items() if id in notes]
+
+    def _search_tasks(self, session: Session, query: str, match: str, limit: int) -> list[Document]:
+        # "#42" or "42" may be a task id, which the text index doesn't contain
+        ids = [int(m.group(1)) for m in (TASK_ID.match(w) for w in query.split()) if m]
+        snippets = {id: None for id in ids}
+        for id, snippet in self._match(session, "tasks_fts", match, limit):
+            if snippets.get(id) is None:
+                snippets[id] = snippet
+        if len(snippets) == 0:
+            return []
+
+        tasks = {t.id: t for t in session.query(Task)
+                 .filter(Task.id.in_(snippets.keys()))
+                 .filter(Task.for_removal == False)}
+
+        return [Document(
+            page_content=snippet or f"{tasks[id].title}: {tasks[id].description}",
+            metadata=TaskMetadata.from_model(tasks[id]).to_dict())
+            for id, snippet in snippets.items() if id in tasks][:limit]
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Fuses vector similarity and BM25 results with reciprocal rank fusion.
+
+    Short queries holding identifiers (snake_case names, error codes, task
+    ids...) are answered by the lexical index alone when the identifiers
+    themselves match, without embedding the query. A match on the other
+    words only goes through fusion like any query.
+    """
+    vector: BaseRetriever
+    index: LexicalIndex
+    kind: DocumentKind
+    k: int = 5
+
+    def _get_relevant_documents(self, query: str) -> list[Document]:
+        if is_lookup(query):
+            exact = self.index.search(self.kind, " ".join(identifiers(query)), self.k)
+            if len(exact) > 0:
+                return exact
+
+        lexical = self.index.search(self.kind, query, self.k)
+        vector = self.vector.invoke(query)
+        return self._fuse(vector, lexical)
+
+    async def _aget_relevant_documents(self, query: str) -> list[Document]:
+        if is_lookup(query):
+            exact = await self.index.asearch(self.kind, " ".join(identifiers(query)), self.k)
+            if len(exact) > 0:
+                return exact
+
+        vector, lexical = await asyncio.gather(
+            self.vector.ainvoke(query),
+            self.index.asearch(self.kind, query, self.k))
+        return self._fuse(vector, lexical)
+
+    def _fuse(self, vector: list[Document], lexical: list[Document]) -> list[Document]:
+        fused = rrf_fuse([vector, lexical], self.k)
+        logger.debug(
+            f"Fused {len(vector)} vector and {len(lexical)} lexical {self.kind.value}s into {len(fused)}")
+        return fused
+
+
+lexical_index = LexicalIndex(registry)
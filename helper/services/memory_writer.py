@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from mem0 import AsyncMemory
+from services.metrics import Trace, metrics
+from setup import Registry, registry
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryJob:
+    def __init__(self, run_id: str, thread_id: int, messages: list[dict[str, any]]):
+        self.run_id = run_id
+        self.thread_id = thread_id
+        self.messages = messages
+        self.turns = 1
+
+    def merge(self, messages: list[dict[str, any]]):
+        # Every turn carries the same kind of system prompt, one is enough
+        self.messages.extend([m for m in messages if m["role"] != "system"])
+        self.turns += 1
+
+    def __repr__(self):
+        return f"MemoryJob(run_id={self.run_id}, turns={self.turns})"
+
+
+class MemoryWriter:
+    """
+    Background ingestion of chat turns into mem0.
+
+    Turns are queued per `run_id`: consecutive turns of a thread that are
+    still waiting are coalesced into a single `AsyncMemory.add` call. A
+    bounded pool of workers drains the queue. When the queue is full,
+    `policy` decides between waiting for room ("block") and dropping the
+    oldest waiting job ("drop").
+    """
+
+    def __init__(self, memory: AsyncMemory, workers: int, capacity: int, policy: str):
+        if policy not in ("block", "drop"):
+            raise ValueError(f"Unknown memory write policy: {policy}")
+
+        self.memory = memory
+        self.workers = workers
+        self.policy = policy
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=capacity)
+        self.pending: dict[str, MemoryJob] = {}
+        self.dropped = 0
+        self.failed = 0
+        self._tasks: list[asyncio.Task] = []
+
+        metrics.gauge("memory_queue_depth", self.depth,
+                      "Chat turns waiting to be written to memory")
+        metrics.gauge("memory_dropped_total", lambda: self.dropped,
+                      "Memory writes dropped because the queue was full")
+        metrics.gauge("memory_failed_total", lambda: self.failed,
+                      "Memory writes that raised an error")
+
+    def depth(self) -> int:
+        return sum(job.turns for job in self.pending.values())
+
+    async def submit(self, run_id: str, thread_id: int, messages: list[dict[str, any]]):
+        self._start()
+
+        if run_id in self.pending:
+            self.pending[run_id].merge(messages)
+            logger.debug(f"Coalesced turn into {self.pending[run_id]}")
+            return
+
+        if self.queue.full() and self.policy == "drop":
+            oldest = self.queue.get_nowait()
+            job = self.pending.pop(oldest, None)
+            self.queue.task_done()
+            self.dropped += job.turns if job else 0
+            logger.warning(f"Memory queue full, dropped {job}")
+
+        self.pending[run_id] = MemoryJob(run_id, thread_id, list(messages))
+        await self.queue.put(run_id)
+
+    def _start(self):
+        if len(self._tasks) > 0:
+            return
+        self._tasks = [asyncio.create_task(self._work(), name=f"MemoryWriter-{i}")
+                       for i in range(self.workers)]
+        logger.info(f"Memory writer started with {self.workers} workers")
+
+    async def _work(self):
+        while True:
+            run_id = await self.queue.get()
+            job = self.pending.pop(run_id, None)
+            try:
+                if job is not None:
+                    await self._write(job)
+            except Exception as e:
+                self.failed += job.turns
+                logger.error(f"Failed to write {job}: {e}", exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    async def _write(self, job: MemoryJob):
+        start = time.perf_counter()
+        await self.memory.add(messages=job.messages, run_id=job.run_id)
+        elapsed = time.perf_counter() - start
+
+        Trace(metrics, "chat").record("add_memory", elapsed)
+        logger.debug(
+            f"Memory for thread {job.thread_id} ({job.turns} turns) added after {elapsed:.3f}s")
+
+    async def drain(self, timeout: float = None):
+        """Wait for queued writes to finish, then stop the workers."""
+        if len(self._tasks) == 0:
+            return
+
+        logger.info(f"Draining memory writer, {self.depth()} turns queued")
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"Memory writer drain timed out, {self.depth()} turns lost")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @staticmethod
+    def from_registry(registry: Registry) -> 'MemoryWriter':
+        configs = registry.get_configs()
+        return MemoryWriter(
+            memory=registry.get_memory(),
+            workers=configs['memory'].getint('workers', 2),
+            capacity=configs['memory'].getint('queueSize', 64),
+            policy=configs['memory'].get('policy', 'block'))
+
+
+memory_writer = MemoryWriter.from_registry(registry)
@@ -0,0 +1,146 @@
+from collections import deque
+from contextlib import contextmanager
+import logging
+import threading
+import time
+from typing import Callable, Generator
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Rolling window of observations, summarized into quantiles."""
+
+    QUANTILES = [0.5, 0.95, 0.99]
+
+    def __init__(self, window: int = 1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.samples.append(value)
+        self.count += 1
+        self.sum += value
+
+    def quantiles(self) -> dict[float, float]:
+        ordered = sorted(self.samples)
+        if len(ordered) == 0:
+            return {q: 0.0 for q in self.QUANTILES}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in self.QUANTILES}
+
+
+class MetricFamily:
+    def __init__(self, name: str, help: str, kind: str):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.series: dict[tuple, Histogram | Callable[[], float]] = {}
+
+
+class MetricsRegistry:
+    """
+    In-process metrics rendered in the Prometheus text format, so they can be
+    scraped (or just curled) without any external collector.
+    """
+
+    def __init__(self, prefix: str = "sidecar"):
+        self.prefix = prefix
+        self._families: dict[str, MetricFamily] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, help: str = "", **labels: str):
+        with self._lock:
+            family = self._family(name, help, "summary")
+            key = tuple(sorted(labels.items()))
+            if key not in family.series:
+                family.series[key] = Histogram()
+            family.series[key].observe(value)
+
+    def gauge(self, name: str, read: Callable[[], float], help: str = "", **labels: str):
+        """Register a gauge whose value is read when metrics are rendered."""
+        with self._lock:
+            family = self._family(name, help, "gauge")
+            family.series[tuple(sorted(labels.items()))] = read
+
+    @contextmanager
+    def time(self, name: str, help: str = "", **labels: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, help, **labels)
+
+    def _family(self, name: str, help: str, kind: str) -> MetricFamily:
+        if name not in self._families:
+            self._families[name] = MetricFamily(
+                f"{self.prefix}_{name}", help, kind)
+        return self._families[name]
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            for family in self._families.values():
+                if family.help:
+                    lines.append(f"# HELP {family.name} {family.help}")
+                lines.append(f"# TYPE {family.name} {family.kind}")
+
+                for key, series in family.series.items():
+                    labels = dict(key)
+                    if family.kind == "gauge":
+                        lines.append(
+                            f"{family.name}{_labels(labels)} {series()}")
+                        continue
+
+                    for q, v in series.quantiles().items():
+                        lines.append(
+                            f"{family.name}{_labels({**labels, 'quantile': str(q)})} {v}")
+                    lines.append(
+                        f"{family.name}_sum{_labels(labels)} {series.sum}")
+                    lines.append(
+                        f"{family.name}_count{_labels(labels)} {series.count}")
+        return "\n".join(lines) + "\n"
+
+
+class Trace:
+    """
+    Timings of the stages of a single operation (e.g. one chat turn). Every
+    span is also fed into the `<name>_stage_seconds` summary.
+    """
+
+    def __init__(self, registry: MetricsRegistry, name: str):
+        self.registry = registry
+        self.name = name
+        self.spans: dict[str, float] = {}
+
+    @contextmanager
+    def span(self, stage: str) -> Generator[None, None, None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def record(self, stage: str, seconds: float):
+        self.spans[stage] = seconds
+        self.registry.observe(f"{self.name}_stage_seconds", seconds,
+                              f"Duration of {self.name} stages in seconds", stage=stage)
+
+    def __repr__(self):
+        spans = ", ".join(f"{k}={v * 1000:.1f}ms" for k,
+                          v in self.spans.items())
+        return f"Trace({self.name}: {spans})"
+
+
+def _labels(labels: dict[str, str]) -> str:
+    if len(labels) == 0:
+        return ""
+    pairs = [f'{k}="{_escape(str(v))}"' for k, v in labels.items()]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = MetricsRegistry()
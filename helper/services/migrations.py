@@ -0,0 +1,300 @@
+import logging
+import threading
+from typing import Callable
+from sqlalchemy import Column, Connection, Engine, inspect, text
+from sqlalchemy.schema import CreateColumn
+from services.models import OTHER_ROLE_RANK, ROLE_RANKS, History, Note, Task, Thread
+from services.ordering import GAP
+from setup import Registry
+
+logger = logging.getLogger(__name__)
+
+
+# Processes up to `batch` rows in the given transaction and returns how many it changed
+Backfill = Callable[[Connection, int], int]
+
+
+class Migration:
+    """
+    A schema change with an optional data backfill.
+
+    `upgrade` runs in a single transaction and should only hold quick DDL.
+    `backfill` is called repeatedly, each batch in its own transaction,
+    until it returns 0. Migrations that are not `required` run in the
+    background after startup, while the API is already serving.
+    """
+
+    def __init__(self, version: int, name: str,
+                 upgrade: Callable[[Connection], None] = None,
+                 backfill: Backfill = None,
+                 required: bool = True):
+        self.version = version
+        self.name = name
+        self.upgrade = upgrade
+        self.backfill = backfill
+        self.required = required
+
+    def __repr__(self):
+        return f"Migration(version={self.version}, name={self.name}, required={self.required})"
+
+
+def add_column(conn: Connection, column: Column):
+    """Add a model column to an existing table. It must have a server default."""
+    table = column.table.name
+    existing = {c['name'] for c in inspect(conn).get_columns(table)}
+    if column.name in existing:
+        return
+    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {ddl}"))
+
+
+def execute(conn: Connection, statements: list[str]):
+    for statement in statements:
+        conn.execute(text(statement))
+
+
+def batched_update(table: str, assignments: str, pending: str) -> Backfill:
+    """
+    Backfill running `UPDATE table SET assignments` over rows matching
+    `pending`, one batch at a time. The assignments must make `pending`
+    false for the updated rows, otherwise the backfill never ends.
+    """
+    statement = text(
+        f"UPDATE {table} SET {assignments} WHERE rowid IN "
+        f"(SELECT rowid FROM {table} WHERE {pending} LIMIT :batch)")
+
+    def backfill(conn: Connection, batch: int) -> int:
+        return conn.execute(statement, {"batch": batch}).rowcount
+
+    return backfill
+
+
+def _chunk_hashes(conn: Connection):
+    add_column(conn, Note.__table__.c.chunk_hashes)
+    add_column(conn, Task.__table__.c.chunk_hashes)
+
+
+def _partial_indexes(conn: Connection):
+    execute(conn, [
+        # Created by init_models before migrations, superseded by the partial index
+        "DROP INDEX IF EXISTS ix_tasks_board_position",
+        "DROP INDEX IF EXISTS ix_tasks_for_removal",
+        "DROP INDEX IF EXISTS ix_notes_for_removal",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_board_position_active ON tasks (board, position) WHERE for_removal = 0",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_due_date_active ON tasks (due_date, priority DESC, created_at DESC) WHERE for_removal = 0",
+        "CREATE INDEX IF NOT EXISTS ix_tasks_removed ON tasks (for_removal) WHERE for_removal = 1",
+        "CREATE INDEX IF NOT EXISTS ix_notes_created_at_active ON notes (created_at DESC) WHERE for_removal = 0",
+        "CREATE INDEX IF NOT EXISTS ix_notes_removed ON notes (for_removal) WHERE for_removal = 1",
+        "ANALYZE",
+    ])
+
+
+def _history_keyset(conn: Connection):
+    add_column(conn, Thread.__table__.c.turn_count)
+    add_column(conn, History.__table__.c.role_rank)
+    execute(conn, [
+        "DROP INDEX IF EXISTS ix_history_thread_id",
+        "DROP INDEX IF EXISTS ix_history_turn_id",
+        "DROP INDEX IF EXISTS ix_history_role",
+        "CREATE INDEX IF NOT EXISTS ix_history_thread_turn_role ON history (thread_id, turn_id, role_rank)",
+    ])
+
+
+# Threads that have turns but no counter yet. The counter must be right before
+# the first new turn is sent, so this backfill is required.
+_thread_turn_count = batched_update(
+    "threads",
+    "turn_count = (SELECT MAX(turn_id) FROM history WHERE history.thread_id = threads.id)",
+    "turn_count = 0 AND EXISTS (SELECT 1 FROM history WHERE history.thread_id = threads.id)")
+
+_history_role_rank = batched_update(
+    "history",
+    "role_rank = CASE role "
+    + " ".join(f"WHEN '{role}' THEN {rank}" for role, rank in ROLE_RANKS.items())
+    + f" ELSE {OTHER_ROLE_RANK} END",
+    "role_rank = 0")
+
+
+def _lexical_index(conn: Connection):
+    execute(conn, [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5 (title, content)",
+        "CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5 (title, description)",
+    ])
+
+
+def _lexical_backfill(conn: Connection, batch: int) -> int:
+    """Index live rows the indexer has not put in the FTS tables yet, notes first."""
+    for table, columns in (("notes", "title, content"), ("tasks", "title, description")):
+        count = conn.execute(text(f"""
+            INSERT INTO {table}_fts (rowid, {columns})
+            SELECT id, {columns} FROM {table}
+            WHERE for_removal = 0 AND id NOT IN (SELECT rowid FROM {table}_fts)
+            LIMIT :batch"""), {"batch": batch}).rowcount
+        if count > 0:
+            return count
+    return 0
+
+
+def _integer_task_positions(conn: Connection):
+    """
+    Renumber boards still holding fractional positions from the old float
+    ordering, keeping their order, with integer gaps.
+    """
+    count = conn.execute(text(f"""
+        UPDATE tasks SET position = ranked.rank * {GAP}
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY board ORDER BY position, id) AS rank
+            FROM tasks
+            WHERE board IN (SELECT DISTINCT board FROM tasks WHERE position != CAST(position AS INTEGER))
+        ) AS ranked
+        WHERE tasks.id = ranked.id""")).rowcount
+    if count > 0:
+        logger.info(f"Renumbered {count} task positions")
+
+
+MIGRATIONS = [
+    Migration(1, "chunk hashes", _chunk_hashes),
+    Migration(2, "partial indexes for task and note access paths", _partial_indexes),
+    Migration(3, "history keyset index and thread turn counter", _history_keyset,
+              backfill=_thread_turn_count),
+    Migration(4, "history role rank backfill", backfill=_history_role_rank, required=False),
+    Migration(5, "full-text index tables for notes and tasks", _lexical_index),
+    Migration(6, "full-text index backfill", backfill=_lexical_backfill, required=False),
+    Migration(7, "integer task positions", _integer_task_positions),
+]
+
+
+class MigrationRunner:
+    """
+    Applies versioned schema migrations on top of `create_all`.
+
+    Applied versions are kept in `schema_version`. Every migration must be
+    idempotent, since on a fresh database `create_all` has already created
+    what it adds, and a backfill interrupted by shutdown starts over from
+    the rows still pending on the next start.
+
+    `run` applies required migrations and blocks until they are done.
+    `start` applies the remaining ones on a background thread, committing
+    backfills in small batches with a pause in between, so that API writes
+    interleave with them on the single writer connection. Required
+    migrations must not depend on background ones.
+    """
+
+    def __init__(self, engine: Engine, migrations: list[Migration] = MIGRATIONS,
+                 batch_size: int = 500, pause: float = 0.05):
+        self.engine = engine
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+        self.batch_size = batch_size
+        self.pause = pause
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def run(self):
+        pending = [m for m in self.pending() if m.required]
+        if len(pending) == 0:
+            logger.info(f"Database schema is up to date at version {self.version()}")
+            return
+
+        for migration in pending:
+            self._apply(migration)
+
+        logger.info(f"Database schema migrated to version {self.version()}")
+
+    def start(self):
+        pending = [m for m in self.pending() if not m.required]
+        if len(pending) == 0:
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(
+            target=self._run_background, name="MigrationRunner", args=(pending,))
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stopping.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run_background(self, pending: list[Migration]):
+        logger.info(f"Applying {len(pending)} migrations in the background")
+        for migration in pending:
+            try:
+                if not self._apply(migration):
+                    return
+            except Exception as e:
+                logger.error(f"Failed to apply {migration}: {e}", exc_info=True)
+                return
+        logger.info(f"Background migrations done at version {self.version()}")
+
+    def _apply(self, migration: Migration) -> bool:
+        logger.info(f"Applying {migration}")
+
+        if migration.backfill is None:
+            with self.engine.begin() as conn:
+                if migration.upgrade is not None:
+                    migration.upgrade(conn)
+                self._record(conn, migration)
+            return True
+
+        if migration.upgrade is not None:
+            with self.engine.begin() as conn:
+                migration.upgrade(conn)
+        if not self._backfill(migration):
+            return False
+        with self.engine.begin() as conn:
+            self._record(conn, migration)
+        return True
+
+    def _backfill(self, migration: Migration) -> bool:
+        total = 0
+        while not self._stopping.is_set():
+            with self.engine.begin() as conn:
+                count = migration.backfill(conn, self.batch_size)
+            if count == 0:
+                logger.info(f"Backfilled {total} rows for {migration}")
+                return True
+
+            total += count
+            logger.debug(f"Backfilled {total} rows so far for {migration}")
+            # Give the writer connection back to the API between batches
+            self._stopping.wait(self.pause)
+
+        logger.info(
+            f"Stopped {migration} after {total} rows, it resumes on the next start")
+        return False
+
+    def _record(self, conn: Connection, migration: Migration):
+        conn.execute(text(
+            "INSERT INTO schema_version (version, name) VALUES (:version, :name)"),
+            {"version": migration.version, "name": migration.name})
+
+    def pending(self) -> list[Migration]:
+        applied = self.applied()
+        return [m for m in self.migrations if m.version not in applied]
+
+    def applied(self) -> set[int]:
+        with self.engine.begin() as conn:
+            self._ensure_table(conn)
+            return set(conn.execute(text("SELECT version FROM schema_version")).scalars())
+
+    def version(self) -> int:
+        with self.engine.begin() as conn:
+            self._ensure_table(conn)
+            return conn.execute(text("SELECT COALESCE(MAX(version), 0) FROM schema_version")).scalar_one()
+
+    def _ensure_table(self, conn: Connection):
+        conn.execute(text("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )"""))
+
+    @staticmethod
+    def from_registry(registry: Registry) -> 'MigrationRunner':
+        configs = registry.get_configs()
+        return MigrationRunner(
+            engine=registry.get_alchemy(),
+            batch_size=configs['sqlite'].getint('migrationBatch', 500),
+            pause=configs['sqlite'].getint('migrationPause', 50) / 1000)
@@ -3,7 +3,7 @@ import logging
 import uuid
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import Mapped, mapped_column
-from sqlalchemy import JSON, Case, DateTime, case, func
+from sqlalchemy import JSON, DateTime, Index, func
 from datetime import datetime
 
 
@@ -11,12 +11,28 @@ Base = declarative_base()
 
 logger = logging.getLogger(__name__)
 
+# Order of messages within a turn, stored on history rows so pages can be
+# read straight off an index
+ROLE_RANKS = {
+    'system': 1,
+    'user': 2,
+    'assistant': 3,
+}
+OTHER_ROLE_RANK = 4
+
+
+def role_rank(role: str) -> int:
+    return ROLE_RANKS.get(role, OTHER_ROLE_RANK)
+
 
 class Thread(Base):
     __tablename__ = 'threads'
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     title: Mapped[str] = mapped_column(nullable=False)
     run_id: Mapped[str] = mapped_column(nullable=False)
+    # Last turn id handed out, incremented atomically by each new turn
+    turn_count: Mapped[int] = mapped_column(
+        nullable=False, default=0, server_default='0')
     created_at: Mapped[datetime] = mapped_column(
         DateTime, nullable=False, default=func.now())
     updated_at: Mapped[datetime] = mapped_column(
@@ -27,6 +43,7 @@ class Thread(Base):
             "id": self.id,
             "title": self.title,
             "run_id": self.run_id,
+            "turn_count": self.turn_count,
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat(),
         }
@@ -35,9 +52,13 @@ class Thread(Base):
 class History(Base):
     __tablename__ = 'history'
     id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    thread_id: Mapped[int] = mapped_column(nullable=False, index=True)
-    turn_id: Mapped[int] = mapped_column(nullable=False, index=True)
-    role: Mapped[str] = mapped_column(nullable=False, index=True)
+    thread_id: Mapped[int] = mapped_column(nullable=False)
+    turn_id: Mapped[int] = mapped_column(nullable=False)
+    role: Mapped[str] = mapped_column(nullable=False)
+    # 0 marks rows written before the column existed, until they are backfilled
+    role_rank: Mapped[int] = mapped_column(
+        nullable=False, server_default='0',
+        default=lambda context: role_rank(context.get_current_parameters()['role']))
     content: Mapped[str] = mapped_column(nullable=False)
     created_at: Mapped[datetime] = mapped_column(
         DateTime, nullable=False, default=func.now())
@@ -99,9 +120,12 @@ class Note(Base):
     is_dirty: Mapped[bool] = mapped_column(
         nullable=False, default=True, index=True)
     for_removal: Mapped[bool] = mapped_column(
-        nullable=False, default=False, index=True)
+        nullable=False, default=False)
     vector_ids: Mapped[list[str]] = mapped_column(
         JSON, nullable=False, default=[])
+    # Hash of each indexed chunk, aligned with `vector_ids`
+    chunk_hashes: Mapped[list[str]] = mapped_column(
+        JSON, nullable=False, default=[], server_default='[]')
 
     @staticmethod
     def build(title: str, content: str) -> 'Note':
@@ -147,9 +171,12 @@ class Task(Base):
     position: Mapped[int] = mapped_column(
         nullable=False, index=True, default=1000)
     for_removal: Mapped[bool] = mapped_column(
-        nullable=False, default=False, index=True)
+        nullable=False, default=False)
     vector_ids: Mapped[list[str]] = mapped_column(
         JSON, nullable=False, default=[])
+    # Hash of each indexed chunk, aligned with `vector_ids`
+    chunk_hashes: Mapped[list[str]] = mapped_column(
+        JSON, nullable=False, default=[], server_default='[]')
     is_dirty: Mapped[bool] = mapped_column(
         nullable=False, default=False, index=True)
 
@@ -168,6 +195,7 @@ class Task(Base):
                     position=position,
                     for_removal=False,
                     vector_ids=[],
+                    chunk_hashes=[],
                     is_dirty=False)
 
     def to_dict(self) -> dict[str, any]:
@@ -183,38 +211,35 @@ class Task(Base):
             "updated_at": self.updated_at.isoformat(),
         }
 
-    def insert_between(self, before: 'Task' = None, after: 'Task' = None) -> bool:
-        MIN_GAP = 1e-5  # Minimum difference to avoid float collision
-        """
-        Update position when it's moved between two tasks.
-        Args:
-            before (Task, optional): Task before the current task. Defaults to None.
-            after (Task, optional): Task after the current task. Defaults to None.
 
-        Returns:
-            bool: True if the position was updated, False if a rebalance is needed.
-        """
-        MIN_GAP = 1e-5  # Minimum difference to avoid float collision
+# Partial indexes on live rows match the `for_removal == False` filter of
+# every read path, and keep the planner away from the low-selectivity flag.
+# Schema changes on existing databases go through services/migrations.py.
 
-        if not before and not after:
-            self.position = 1000
-            return True
+# Board listing and neighbor lookups when placing a task within a board
+Index('ix_tasks_board_position_active',
+      Task.board, Task.position,
+      sqlite_where=Task.for_removal == False)
 
-        elif before and not after:
-            self.position = before.position + 1000
-            return True
+# Due date lookups (`list_by_duedate_*`), in the order they are returned
+Index('ix_tasks_due_date_active',
+      Task.due_date, Task.priority.desc(), Task.created_at.desc(),
+      sqlite_where=Task.for_removal == False)
 
-        elif not before and after:
-            self.position = after.position / 2
-            return True
+# Removal sweeps of the indexer
+Index('ix_tasks_removed', Task.for_removal,
+      sqlite_where=Task.for_removal == True)
 
-        elif before and after:
-            gap = after.position - before.position
-            if gap <= MIN_GAP:
-                # No room to insert between — signal rebalance needed
-                return False
-            self.position = (before.position + after.position) / 2
-            return True
+# Notes listing, newest first
+Index('ix_notes_created_at_active', Note.created_at.desc(),
+      sqlite_where=Note.for_removal == False)
+
+Index('ix_notes_removed', Note.for_removal,
+      sqlite_where=Note.for_removal == True)
+
+# Keyset pages of a thread's messages, the implicit rowid breaks ties
+Index('ix_history_thread_turn_role',
+      History.thread_id, History.turn_id, History.role_rank)
 
 
 def init_models(engine):
@@ -225,19 +250,3 @@ def init_models(engine):
 def new_run_id() -> str:
     return str(uuid.uuid4())
 
-
-def rebalance_tasks(tasks: list[Task]):
-    s = 1000
-    for task in tasks:
-        task.position = s
-        s += 1000
-    return tasks
-
-
-def role_order() -> Case:
-    return case(
-        (History.role == 'system', 1),
-        (History.role == 'user', 2),
-        (History.role == 'assistant', 3),
-        else_=4
-    )
@@ -2,6 +2,7 @@ from datetime import datetime
 import logging
 from pydantic import BaseModel
 from requests import Session
+from services.changes import DocumentKind, change_feed
 from services.models import KanbanBoards, Note, TaskPriority
 from setup import Registry
 
@@ -36,6 +37,7 @@ class NotesService():
 
             session.add(note)
             session.commit()
+        change_feed.publish(DocumentKind.NOTE, note.id)
         return note.id
 
     def delete(self, id: int):
@@ -45,6 +47,7 @@ class NotesService():
                 raise ValueError(f"Note {id} not found")
             note.for_removal = True
             session.commit()
+        change_feed.publish(DocumentKind.NOTE, id)
         return
 
     def list(self) -> list[Note]:
@@ -72,6 +75,7 @@ class NotesService():
 
             note.is_dirty = True
             session.commit()
+        change_feed.publish(DocumentKind.NOTE, id)
         return
 
     def _get(self, session: Session, id: int) -> Note:
@@ -79,6 +83,21 @@ class NotesService():
             .filter(Note.id == id) \
             .first()
 
+    async def acreate(self, request: CreateNoteRequest) -> int:
+        return await self.registry.run_db(self.create, request)
+
+    async def adelete(self, id: int):
+        return await self.registry.run_db(self.delete, id)
+
+    async def alist(self) -> 'list[Note]':
+        return await self.registry.run_db(self.list)
+
+    async def aget(self, id: int) -> Note:
+        return await self.registry.run_db(self.get, id)
+
+    async def aupdate(self, id: int, request: UpdateNoteRequest):
+        return await self.registry.run_db(self.update, id, request)
+
 
 class DocumentMetadata(BaseModel):
     id: int
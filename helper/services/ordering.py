@@ -0,0 +1,96 @@
+import logging
+from sqlalchemy.orm import Session
+from services.models import Task
+
+logger = logging.getLogger(__name__)
+
+# Distance between consecutive tasks after a rebalance
+GAP = 1000
+
+# Tasks taken on each side of the insertion point by the first rebalance attempt
+WINDOW = 8
+
+
+def position_between(before: int | None, after: int | None) -> int | None:
+    """
+    Integer position strictly between two neighbors, or None if they are
+    adjacent and a rebalance is needed.
+    """
+    if before is None and after is None:
+        return GAP
+    if after is None:
+        return before + GAP
+    if before is None:
+        return after - GAP
+    if after - before < 2:
+        return None
+    return (before + after) // 2
+
+
+class TaskOrdering:
+    """
+    Orders tasks within a board by integer positions with gaps.
+
+    Placing a task between two neighbors writes only that task as long as
+    there is a gap between them. When there is none, positions are spread
+    over a small window around the insertion point, doubling the window
+    until it fits, all within the caller's transaction.
+    """
+
+    def __init__(self, session: Session):
+        self.session = session
+
+    def place(self, task: Task, before: Task = None, after: Task = None):
+        position = position_between(
+            before.position if before else None,
+            after.position if after else None)
+
+        if position is not None:
+            task.position = position
+            return
+
+        self._rebalance(task, before, after)
+
+    def _rebalance(self, task: Task, before: Task, after: Task):
+        window = WINDOW
+
+        while True:
+            lower = self._neighbors(task, before.position, window + 1, below=True)
+            upper = self._neighbors(task, after.position, window + 1, below=False)
+
+            # One extra row on each side is the fixed bound of the window
+            lower_bound = lower[window].position if len(lower) > window else None
+            upper_bound = upper[window].position if len(upper) > window else None
+            rows = list(reversed(lower[:window])) + [task] + upper[:window]
+
+            if lower_bound is None and upper_bound is None:
+                lower_bound, upper_bound = 0, (len(rows) + 1) * GAP
+            elif lower_bound is None:
+                lower_bound = upper_bound - (len(rows) + 1) * GAP
+            elif upper_bound is None:
+                upper_bound = lower_bound + (len(rows) + 1) * GAP
+
+            span = upper_bound - lower_bound
+            if span > len(rows):
+                for i, row in enumerate(rows):
+                    row.position = lower_bound + span * (i + 1) // (len(rows) + 1)
+                logger.debug(
+                    f"Rebalanced {len(rows)} tasks on board {task.board}")
+                return
+
+            window *= 2
+
+    def _neighbors(self, task: Task, position: int, limit: int, below: bool) -> list[Task]:
+        query = self.session.query(Task) \
+            .filter(Task.board == task.board) \
+            .filter(Task.for_removal == False) \
+            .filter(Task.id != task.id)
+
+        if below:
+            query = query.filter(Task.position <= position) \
+                .order_by(Task.position.desc())
+        else:
+            query = query.filter(Task.position >= position) \
+                .order_by(Task.position.asc())
+
+        return query.limit(limit).all()
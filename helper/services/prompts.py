@@ -26,10 +26,9 @@ class PromptService:
         - "{content}"
         """
 
-    def build_chat_system_prompt(self, memory: list[Document], content: str) -> str:
-        memory_str = ""
-
-        history = []
+    def format_documents(self, memory: list[Document]) -> dict[str, list[str]]:
+        """Render retrieved documents as prompt items, grouped into tasks, notes and memory."""
+        memories = []
         notes = []
         tasks = []
 
@@ -46,19 +45,26 @@ class PromptService:
                 tasks.append(task_str)
             else:
                 history_str = self._build_history_str(m.page_content)
-                history.append(history_str)
+                memories.append(history_str)
+
+        return {
+            "tasks": tasks,
+            "notes": notes,
+            "memory": memories,
+        }
 
-        history_str = "\n".join(history)
-        notes_str = "\n".join(notes)
-        tasks_str = "\n".join(tasks)
+    def build_chat_system_prompt(self, sections: dict[str, list[str]]) -> str:
+        tasks_str = "\n".join(sections.get("tasks", []))
+        notes_str = "\n".join(sections.get("notes", []))
+        memory_str = "\n".join(sections.get("memory", []))
 
-        memory_str = f"""
+        context_str = f"""
         1. Tasks:
         {tasks_str}
         2. Notes:
         {notes_str}
-        3. History:
-        {history_str}
+        3. Memories from earlier conversations:
+        {memory_str}
         """
 
         return f"""
@@ -66,7 +72,7 @@ class PromptService:
         You specialize in software engineering, computer science, and coding. 
         Your job is to provide clear, summarized, and actionable responses using all available context: chat history, notes, and tasks. 
         Always prioritize clarity and relevance.
-        Here's the conversation history, notes, and tasks: \n\n{memory_str}.
+        The recent conversation follows as messages. Here are the notes, tasks and memories: \n\n{context_str}.
         """
 
 
@@ -0,0 +1,89 @@
+import logging
+import re
+import threading
+from sqlalchemy import Engine, event
+
+logger = logging.getLogger(__name__)
+
+# `SCAN tasks` is a full table scan, `SCAN tasks USING [COVERING] INDEX ...` walks an index
+FULL_SCAN = re.compile(r"^SCAN (\w+)$")
+TEMP_SORT = "USE TEMP B-TREE FOR ORDER BY"
+WHERE = re.compile(r"\bWHERE\b", re.IGNORECASE)
+
+
+class QueryPlanError(Exception):
+    pass
+
+
+class QueryPlanAuditor:
+    """
+    Checks `EXPLAIN QUERY PLAN` of every distinct filtered SELECT an engine
+    runs, and reports full table scans and sorts no index can satisfy.
+
+    In "warn" mode problems are logged, in "raise" mode the query fails with
+    a QueryPlanError, so a missing index shows up the first time a service
+    query runs in development instead of on a large database.
+    """
+
+    def __init__(self, mode: str):
+        if mode not in ("off", "warn", "raise"):
+            raise ValueError(f"Unknown query audit mode: {mode}")
+        self.mode = mode
+        self._seen: set[str] = set()
+        self._lock = threading.Lock()
+
+    def attach(self, engine: Engine):
+        if self.mode == "off":
+            return
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        logger.info(f"Auditing query plans ({self.mode})")
+
+    def explain(self, dbapi_connection, statement: str, parameters) -> list[str]:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+            return [row[3] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def tables(self, dbapi_connection) -> set[str]:
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+            return {row[0] for row in cursor.fetchall()}
+        finally:
+            cursor.close()
+
+    def problems(self, plan: list[str], tables: set[str]) -> list[str]:
+        found = []
+        for detail in plan:
+            scan = FULL_SCAN.match(detail)
+            # Scans of subqueries and CTEs are expected, only tables matter
+            if scan and scan.group(1) in tables:
+                found.append(f"full scan: {detail}")
+            elif detail.startswith(TEMP_SORT):
+                found.append(f"unindexed sort: {detail}")
+        return found
+
+    def _before_execute(self, conn, cursor, statement: str, parameters, context, executemany: bool):
+        if executemany or not statement.lstrip().upper().startswith("SELECT"):
+            return
+        # Listing a whole table is expected to scan it
+        if not WHERE.search(statement):
+            return
+
+        with self._lock:
+            if statement in self._seen:
+                return
+            self._seen.add(statement)
+
+        dbapi_connection = conn.connection.dbapi_connection
+        problems = self.problems(
+            self.explain(dbapi_connection, statement, parameters), self.tables(dbapi_connection))
+        if len(problems) == 0:
+            return
+
+        message = f"Query plan issues ({'; '.join(problems)}) for: {' '.join(statement.split())}"
+        if self.mode == "raise":
+            raise QueryPlanError(message)
+        logger.warning(message)
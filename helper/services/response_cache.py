@@ -0,0 +1,173 @@
+import hashlib
+import logging
+import threading
+import time
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from services.changes import DocumentKind, change_feed
+from services.kanban import TaskMetadata
+from services.metrics import metrics
+from services.models import Note, Task
+from services.notes import DocumentMetadata
+from setup import Registry
+
+logger = logging.getLogger(__name__)
+
+# Columns whose values make up the fingerprint. `updated_at` alone has one
+# second resolution in SQLite, so the content is hashed along with it.
+FINGERPRINT_COLUMNS = (
+    ("note", Note, (Note.id, Note.title, Note.content, Note.updated_at, Note.for_removal)),
+    ("task", Task, (Task.id, Task.title, Task.description, Task.board, Task.priority,
+                    Task.due_date, Task.updated_at, Task.for_removal)),
+)
+
+
+class CachedResponse:
+    def __init__(self, query: str, vector: np.ndarray, content: str,
+                 notes: list[int], tasks: list[int], fingerprint: str):
+        self.query = query
+        self.vector = vector
+        self.content = content
+        self.notes = notes
+        self.tasks = tasks
+        self.fingerprint = fingerprint
+        self.created = time.monotonic()
+
+    def __repr__(self):
+        return f"CachedResponse(query={self.query}, notes={len(self.notes)}, tasks={len(self.tasks)})"
+
+
+class ResponseCache:
+    """
+    Answers to earlier chat queries, matched by query embedding similarity.
+
+    Only answers whose prompt is the question and retrieved notes and tasks
+    are cached: the chat service consults it for the first turn of a thread
+    only, and answers built on mem0 memories, which belong to one
+    conversation, are not stored.
+
+    Each answer keeps the notes and tasks its context was built from and a
+    fingerprint of their current rows, checked again before it is
+    served. Any note or task write clears the cache, since a new or edited
+    document may belong in the context of any cached query; the fingerprint
+    also catches writes that didn't go through the change feed. Answers
+    expire after `ttl` seconds, and the oldest are evicted past `capacity`.
+    """
+
+    def __init__(self, registry: Registry, embeddings: Embeddings,
+                 ttl: float, similarity: float, capacity: int):
+        self.registry = registry
+        self.embeddings = embeddings
+        self.ttl = ttl
+        self.similarity = similarity
+        self.capacity = capacity
+        self.entries: list[CachedResponse] = []
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        change_feed.subscribe(self.invalidate)
+        metrics.gauge("response_cache_entries", lambda: len(self.entries),
+                      "Chat answers in the response cache")
+        metrics.gauge("response_cache_hits_total", lambda: self.hits,
+                      "Chat turns answered from the response cache")
+        metrics.gauge("response_cache_misses_total", lambda: self.misses,
+                      "Chat turns not found in the response cache")
+
+    def invalidate(self, kind: DocumentKind, id: int):
+        with self._lock:
+            self.generation += 1
+            if len(self.entries) > 0:
+                logger.debug(
+                    f"Response cache cleared by {kind.value} {id}, {len(self.entries)} entries")
+            self.entries = []
+
+    async def lookup(self, query: str) -> tuple[str, int]:
+        """
+        Returns:
+            tuple[str, int]: The cached answer or None, and the cache
+            generation to pass to `store` once the answer is computed.
+        """
+        vector = self._normalize(await self.embeddings.aembed_query(query))
+
+        with self._lock:
+            generation = self.generation
+            self._expire()
+            entry = self._nearest(vector)
+
+        if entry is not None:
+            fingerprint = await self.registry.run_db(self._fingerprint, entry.notes, entry.tasks)
+            if fingerprint == entry.fingerprint:
+                self.hits += 1
+                logger.debug(f"Response cache hit for {entry}")
+                return entry.content, generation
+            self._remove(entry)
+
+        self.misses += 1
+        return None, generation
+
+    async def store(self, query: str, documents: list[Document], content: str, generation: int):
+        if any(not DocumentMetadata.is_note(d.metadata) and not TaskMetadata.is_task(d.metadata)
+               for d in documents):
+            return
+
+        notes = sorted({d.metadata["id"] for d in documents if DocumentMetadata.is_note(d.metadata)})
+        tasks = sorted({d.metadata["id"] for d in documents if TaskMetadata.is_task(d.metadata)})
+        fingerprint = await self.registry.run_db(self._fingerprint, notes, tasks)
+        vector = self._normalize(await self.embeddings.aembed_query(query))
+
+        with self._lock:
+            # A write landed while the answer was generated, it may be stale already
+            if generation != self.generation:
+                return
+            self.entries.append(CachedResponse(query, vector, content, notes, tasks, fingerprint))
+            if len(self.entries) > self.capacity:
+                self.entries = self.entries[-self.capacity:]
+
+    def _nearest(self, vector: np.ndarray) -> CachedResponse:
+        if len(self.entries) == 0:
+            return None
+        scores = np.stack([e.vector for e in self.entries]) @ vector
+        best = int(np.argmax(scores))
+        return self.entries[best] if scores[best] >= self.similarity else None
+
+    def _expire(self):
+        now = time.monotonic()
+        self.entries = [e for e in self.entries if now - e.created < self.ttl]
+
+    def _remove(self, entry: CachedResponse):
+        with self._lock:
+            self.entries = [e for e in self.entries if e is not entry]
+
+    def _normalize(self, vector: list[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm > 0 else array
+
+    def _fingerprint(self, notes: list[int], tasks: list[int]) -> str:
+        digest = hashlib.sha256()
+        ids_by_kind = {"note": notes, "task": tasks}
+        with self.registry.get_session() as session:
+            for kind, model, columns in FINGERPRINT_COLUMNS:
+                ids = ids_by_kind[kind]
+                if len(ids) == 0:
+                    continue
+                rows = session.query(*columns) \
+                    .filter(model.id.in_(ids)) \
+                    .order_by(model.id) \
+                    .all()
+                for row in rows:
+                    digest.update(f"{kind}:{tuple(row)!r};".encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def from_registry(registry: Registry) -> 'ResponseCache':
+        configs = registry.get_configs()
+        return ResponseCache(
+            registry=registry,
+            embeddings=registry.get_embeddings(),
+            ttl=configs['chat'].getint('responseCacheTtl', 600),
+            similarity=configs['chat'].getfloat('responseCacheSimilarity', 0.95),
+            capacity=configs['chat'].getint('responseCacheSize', 256))
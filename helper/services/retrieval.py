@@ -0,0 +1,129 @@
+import asyncio
+from configparser import ConfigParser
+import logging
+import time
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from services.metrics import Trace
+
+logger = logging.getLogger(__name__)
+
+
+class RetrievalSource:
+    def __init__(self, name: str, retriever: BaseRetriever, timeout: float):
+        self.name = name
+        self.retriever = retriever
+        self.timeout = timeout
+
+    def __repr__(self):
+        return f"RetrievalSource(name={self.name}, timeout={self.timeout})"
+
+    @staticmethod
+    def from_config(configs: ConfigParser, name: str, retriever: BaseRetriever) -> 'RetrievalSource':
+        timeout = configs['retrieval'].getint(f'{name}Timeout', 1000) / 1000
+        return RetrievalSource(name=name, retriever=retriever, timeout=timeout)
+
+
+class RetrievalResult:
+    def __init__(self, documents: list[Document], dropped: list[str]):
+        self.documents = documents
+        self.dropped = dropped
+
+    def is_partial(self) -> bool:
+        return len(self.dropped) > 0
+
+
+class RetrievalOrchestrator:
+    """
+    Queries all retrieval sources concurrently. Each source has its own
+    deadline and the whole fan-out is capped by a global budget, a source that
+    misses either is dropped and the turn continues with partial context.
+    """
+
+    def __init__(self, budget: float):
+        self.budget = budget
+
+    async def retrieve(self, query: str, sources: list[RetrievalSource], trace: Trace = None) -> RetrievalResult:
+        start = time.monotonic()
+        tasks = [asyncio.create_task(self._run(s, query, trace))
+                 for s in sources]
+
+        try:
+            done, pending = await asyncio.wait(tasks, timeout=self.budget)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+        for task in pending:
+            task.cancel()
+
+        ranked = []
+        dropped = []
+        for source, task in zip(sources, tasks):
+            if task not in done:
+                logger.warning(
+                    f"Retrieval source {source.name} missed the {self.budget}s budget")
+                dropped.append(source.name)
+            elif task.exception() is not None:
+                e = task.exception()
+                if isinstance(e, asyncio.TimeoutError):
+                    logger.warning(
+                        f"Retrieval source {source.name} timed out after {source.timeout}s")
+                else:
+                    logger.error(
+                        f"Retrieval source {source.name} failed: {e}")
+                dropped.append(source.name)
+            else:
+                ranked.append(task.result())
+
+        logger.debug(
+            f"Retrieval finished after {time.monotonic() - start:.3f}s, dropped: {dropped}")
+        return RetrievalResult(documents=self._merge(ranked), dropped=dropped)
+
+    async def retrieve_speculative(self, query: str, local: list[RetrievalSource], deferred: list[RetrievalSource], grace: float, trace: Trace = None) -> RetrievalResult:
+        """
+        Return as soon as the `local` sources are done. `deferred` sources
+        run alongside and are only included if they finish within `grace`
+        seconds after that, otherwise they are dropped.
+        """
+        deferred_task = asyncio.create_task(
+            self.retrieve(query, deferred, trace))
+        try:
+            local_result = await self.retrieve(query, local, trace)
+            done, _ = await asyncio.wait([deferred_task], timeout=grace)
+        except asyncio.CancelledError:
+            deferred_task.cancel()
+            raise
+
+        if deferred_task not in done:
+            deferred_task.cancel()
+            logger.debug(
+                f"Deferred sources missed the {grace}s grace window")
+            deferred_result = RetrievalResult(
+                documents=[], dropped=[s.name for s in deferred])
+        else:
+            deferred_result = deferred_task.result()
+
+        return RetrievalResult(
+            documents=self._merge(
+                [deferred_result.documents, local_result.documents]),
+            dropped=deferred_result.dropped + local_result.dropped)
+
+    async def _run(self, source: RetrievalSource, query: str, trace: Trace = None) -> list[Document]:
+        start = time.perf_counter()
+        try:
+            return await asyncio.wait_for(source.retriever.ainvoke(query), timeout=source.timeout)
+        finally:
+            if trace is not None:
+                trace.record(f"retrieve_{source.name}",
+                             time.perf_counter() - start)
+
+    def _merge(self, ranked: list[list[Document]]) -> list[Document]:
+        # Interleave by rank, like MergerRetriever does
+        merged = []
+        longest = max([len(docs) for docs in ranked], default=0)
+        for i in range(longest):
+            for docs in ranked:
+                if i < len(docs):
+                    merged.append(docs[i])
+        return merged
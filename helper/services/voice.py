@@ -1,12 +1,36 @@
 import asyncio
+from collections import deque
+from concurrent.futures import Future
 import logging
-from audio import AudioRecorder, get_inputs
+import numpy as np
+from pydantic import BaseModel
+from pywhispercpp.model import Segment
+from audio import AudioConstants, AudioRecorder, SpeechChunker, VoiceActivity, decode_audio, get_inputs
 from services.config import ConfigKey, ConfigService
 from setup import Registry
-from typing import Callable, Awaitable
+from transcription import TranscriptionBusy, TranscriptionSession
+from typing import AsyncIterator, Callable, Awaitable
 
 logger = logging.getLogger(__name__)
 
+# Seconds the last transcripts of a stopped recording have to reach the client
+DRAIN_TIMEOUT = 5
+
+
+class TranscribeResponse(BaseModel):
+    code: int
+    content: str
+    start: float | None = None
+    end: float | None = None
+
+    @staticmethod
+    def from_segment(segment: Segment, offset: float) -> 'TranscribeResponse':
+        unit = AudioConstants.SEGMENT_TIME_UNIT / AudioConstants.SAMPLE_RATE
+        return TranscribeResponse(
+            code=200,
+            content=segment.text,
+            start=round(offset + segment.t0 * unit, 2),
+            end=round(offset + segment.t1 * unit, 2))
 
 
 class VoiceService():
@@ -15,25 +39,59 @@ class VoiceService():
         self.config_service = config_service
         return
 
-    def start_record(self, device_id: int, on_data: Callable[[str], Awaitable[None]], on_error: Callable[[Exception], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+    async def start_record(self, device_id: int, on_data: Callable[[str], Awaitable[None]], on_error: Callable[[Exception], Awaitable[None]],
+                           on_partial: Callable[[str], Awaitable[None]] = None) -> Callable[[], Awaitable[None]]:
+        loop = asyncio.get_running_loop()
         aqueue = asyncio.Queue()
-        on_data_recv = self.sync_on_data(aqueue)
-        on_error_recv = self.sync_on_error(aqueue)
+        on_data_recv = self.sync_on_data(loop, aqueue)
+        on_error_recv = self.sync_on_error(loop, aqueue)
+        on_partial_recv = self.sync_on_partial(
+            loop, aqueue) if on_partial is not None else None
 
         device_id = self._resolve_device_id(device_id)
 
-        recorder = AudioRecorder(
-            registry=self.registry, on_data=on_data_recv, on_error=on_error_recv)
-        recorder.start(device=device_id)
+        session = await self._open_session(f"live:{device_id}")
+
+        partial_interval = self.registry.get_configs()['voice'].getint('partialInterval', 400)
+        recorder = None
+        try:
+            recorder = AudioRecorder(
+                registry=self.registry, session=session, on_data=on_data_recv, on_error=on_error_recv,
+                on_partial=on_partial_recv, partial_interval=partial_interval / 1000)
+            recorder.start(device=device_id)
+        except Exception:
+            try:
+                if recorder is not None:
+                    await asyncio.to_thread(recorder.stop)
+            finally:
+                session.close()
+            raise
 
         task = asyncio.create_task(
-            self.consume_queue(aqueue, on_data, on_error))
+            self.consume_queue(aqueue, on_data, on_error, on_partial))
         logger.info("Audio recording started")
 
-        cancel = self.canceler(recorder, aqueue, task)
+        cancel = self.canceler(recorder, session, aqueue, task)
 
         return cancel
 
+    async def _open_session(self, name: str) -> TranscriptionSession:
+        """
+        Open a transcription session off the event loop, it may wait for a
+        free one (see [voice] overload). If the caller goes away meanwhile,
+        the session it would have got is closed as soon as it is admitted.
+        """
+        loop = asyncio.get_running_loop()
+        opening = loop.run_in_executor(None, self.registry.get_voice().open_session, name)
+        try:
+            return await asyncio.shield(opening)
+        except asyncio.CancelledError:
+            def close(future: asyncio.Future):
+                if not future.cancelled() and future.exception() is None:
+                    future.result().close()
+            opening.add_done_callback(close)
+            raise
+
     def _resolve_device_id(self, device_id: int | None) -> int:
         devices = get_inputs()
         logger.info(f"Using audio input ID: {device_id}")
@@ -62,7 +120,8 @@ class VoiceService():
 
             raise Exception("No audio devices found")
 
-    async def consume_queue(self, q: asyncio.Queue, on_data: Callable[[str], Awaitable[None]], on_error: Callable[[Exception], Awaitable[None]]):
+    async def consume_queue(self, q: asyncio.Queue, on_data: Callable[[str], Awaitable[None]], on_error: Callable[[Exception], Awaitable[None]],
+                            on_partial: Callable[[str], Awaitable[None]] = None):
         while True:
             try:
                 msg_type, payload = await q.get()
@@ -71,36 +130,105 @@ class VoiceService():
                     break
                 if msg_type == 'data':
                     await on_data(payload)
+                elif msg_type == 'partial':
+                    await on_partial(payload)
                 elif msg_type == 'error':
                     await on_error(payload)
             except asyncio.CancelledError:
                 logger.info("Queue consumer cancelled")
                 break
 
-    def canceler(self, recorder, aqueue: asyncio.Queue, task: asyncio.Task) -> Callable[[], Awaitable[None]]:
+    def canceler(self, recorder, session: TranscriptionSession, aqueue: asyncio.Queue, task: asyncio.Task) -> Callable[[], Awaitable[None]]:
         async def _cancel():
             logger.info("Cancelling audio recording")
-            recorder.stop()
+            try:
+                # Waits for the inference worker, which may be mid transcription
+                await asyncio.to_thread(recorder.stop)
+            finally:
+                session.close()
             await aqueue.put((None, None))  # Sentinel to shut down consumer
-            if not task.done():
-                task.cancel()
             try:
-                await task
-            except asyncio.CancelledError:
-                pass
+                # The worker commits the utterance in progress on stop, the
+                # consumer sends it before reaching the sentinel
+                await asyncio.wait_for(task, timeout=DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Queue consumer did not drain in time, dropping the rest")
         return _cancel
 
-    def sync_on_data(self, q: asyncio.Queue) -> Callable[[str], None]:
+    # The callbacks run on the recorder's inference thread, asyncio.Queue is
+    # not thread-safe so the put is handed to the event loop
+
+    def sync_on_data(self, loop: asyncio.AbstractEventLoop, q: asyncio.Queue) -> Callable[[str], None]:
         def on_data_recv(data: str) -> None:
             logger.debug(f"Received data: {data}")
-            q.put_nowait(('data', data))
+            loop.call_soon_threadsafe(q.put_nowait, ('data', data))
         return on_data_recv
 
-    def sync_on_error(self, q: asyncio.Queue) -> Callable[[Exception], None]:
+    def sync_on_partial(self, loop: asyncio.AbstractEventLoop, q: asyncio.Queue) -> Callable[[str], None]:
+        def on_partial_recv(data: str) -> None:
+            loop.call_soon_threadsafe(q.put_nowait, ('partial', data))
+        return on_partial_recv
+
+    def sync_on_error(self, loop: asyncio.AbstractEventLoop, q: asyncio.Queue) -> Callable[[Exception], None]:
         def on_error_recv(error: Exception) -> None:
             logger.error(f"Error in audio recording: {error}")
-            q.put_nowait(('error', error))
+            loop.call_soon_threadsafe(q.put_nowait, ('error', error))
         return on_error_recv
 
+    async def transcribe(self, source: AsyncIterator[bytes], name: str) -> AsyncIterator[TranscribeResponse]:
+        """
+        Transcribe an uploaded recording as it is received.
+
+        The audio is cut at pauses into chunks decoded in parallel on the
+        model contexts; segments are yielded in order, timed from the start
+        of the recording.
+        """
+        configs = self.registry.get_configs()['voice']
+        engine = self.registry.get_voice()
+        try:
+            session = await self._open_session(f"file:{name}")
+        except TranscriptionBusy as e:
+            yield TranscribeResponse(code=503, content=str(e))
+            return
+
+        chunker = SpeechChunker(
+            VoiceActivity(self.registry.get_webrtc_vad()),
+            min_samples=configs.getint('chunkSeconds', 20) * AudioConstants.SAMPLE_RATE)
+        # Enough chunks to keep every context busy, without buffering the file
+        in_flight = 2 * engine.contexts
+        pending: deque[tuple[int, Future]] = deque()
+        padding = np.zeros(AudioConstants.SAMPLE_RATE + 10, dtype=np.float32)
+        chunks = 0
+
+        def submit(ready: list[tuple[int, np.ndarray]]):
+            for start, samples in ready:
+                # Appending zeros to the audio data as a workaround for small audio packets (small commands)
+                pending.append((start, session.submit(np.concatenate([samples, padding]))))
+
+        async def next_segments() -> list[TranscribeResponse]:
+            start, future = pending.popleft()
+            segments = await asyncio.wrap_future(future)
+            offset = start / AudioConstants.SAMPLE_RATE
+            return [TranscribeResponse.from_segment(s, offset) for s in segments]
+
+        try:
+            async for samples in decode_audio(source, configs.get('ffmpeg', 'ffmpeg')):
+                ready = chunker.feed(samples)
+                chunks += len(ready)
+                submit(ready)
+                while len(pending) > 0 and (len(pending) >= in_flight or pending[0][1].done()):
+                    for response in await next_segments():
+                        yield response
+
+            ready = chunker.flush()
+            chunks += len(ready)
+            submit(ready)
+            while len(pending) > 0:
+                for response in await next_segments():
+                    yield response
+            logger.info(f"Transcribed {name} in {chunks} chunks")
+        finally:
+            session.close()
+
     def list_devices(self):
         return get_inputs()
@@ -1,15 +1,19 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
+import functools
 import logging
 import os
+from typing import Callable, TypeVar
 from browser_use import Agent
-from langchain_openai import OpenAI, OpenAIEmbeddings, ChatOpenAI
+from langchain_openai import OpenAI, ChatOpenAI
 from pydantic import SecretStr
-from pywhispercpp.model import Model
 from langchain_chroma import Chroma
-import sqlite3
 from sqlalchemy import create_engine
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
 from sqlalchemy.orm import sessionmaker, Session
 from config import read_config
 from log import setup_logger
@@ -17,9 +21,16 @@ import webrtcvad
 from mem0 import AsyncMemory
 from mem0.configs.base import MemoryConfig
 from langchain_core.vectorstores import VectorStoreRetriever
+from langchain_core.embeddings import Embeddings
+from embed_cache import CachedEmbeddings, EmbeddingStore
+from embed_provider import init_provider
+from services.query_plan import QueryPlanAuditor
+from transcription import TranscriptionEngine
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 def init_model(configs: ConfigParser) -> OpenAI:
     chat_model = configs['chat']['name']
@@ -47,30 +58,27 @@ def init_chat_model(configs: ConfigParser, tools: list[any] = []) -> ChatOpenAI:
     return m
 
 
-def init_whisper_model(configs: ConfigParser) -> Model:
-    model = configs['voice']['name']
-    dir = configs['voice']['directory']
+def init_whisper_model(configs: ConfigParser) -> TranscriptionEngine:
+    logger.info(f"Using Whisper voice-to-text model: {configs['voice']['name']}")
+    return TranscriptionEngine.from_config(configs)
 
-    logger.info(f"Using Whisper voice-to-text model: {model}")
-    return Model(
-        model=model,
-        models_dir=dir,
-        n_threads=4
-    )
 
+def init_embeddings(configs: ConfigParser) -> CachedEmbeddings:
+    embeddings, embeddings_model = init_provider(configs)
+    logger.info(
+        f"Using embeddings model: {embeddings_model} ({configs['embeddings'].get('provider', 'openai')})")
 
-def init_embeddings(configs: ConfigParser) -> OpenAIEmbeddings:
-    embeddings_model = configs['embeddings']['name']
-    logger.info(f"Using embeddings model: {embeddings_model}")
-    return OpenAIEmbeddings(
-        api_key=SecretStr(configs['embeddings']['token']),
-        base_url=configs['embeddings']['baseUrl'],
+    store = EmbeddingStore(
+        path=configs['embeddings']['cache'],
+        max_bytes=configs['embeddings'].getint('cacheSize', 256) * 1024 * 1024)
+    return CachedEmbeddings(
+        embeddings=embeddings,
         model=embeddings_model,
-        max_retries=3
-    )
+        store=store,
+        memory_items=configs['embeddings'].getint('cacheItems', 10000))
 
 
-def init_vector_db(configs: ConfigParser, path: str, embeddings: OpenAIEmbeddings, collection: str) -> Chroma:
+def init_vector_db(configs: ConfigParser, path: str, embeddings: Embeddings, collection: str) -> Chroma:
     logger.info(f"Using vector database at: {path}")
     return Chroma(
         persist_directory=path,
@@ -79,17 +87,21 @@ def init_vector_db(configs: ConfigParser, path: str, embeddings: OpenAIEmbedding
     )
 
 
-def sqlite_pragmas() -> list[str]:
+def sqlite_pragmas(configs: ConfigParser) -> list[str]:
+    sqlite = configs['sqlite']
     return [
         "PRAGMA foreign_keys=ON;",
         "PRAGMA journal_mode=WAL;",
-        "PRAGMA synchronous=NORMAL;"
+        "PRAGMA synchronous=NORMAL;",
+        f"PRAGMA cache_size={sqlite.getint('cacheSize', -20000)};",
+        f"PRAGMA mmap_size={sqlite.getint('mmapSize', 268435456)};",
+        f"PRAGMA temp_store={sqlite.get('tempStore', 'MEMORY')};",
+        f"PRAGMA busy_timeout={sqlite.getint('busyTimeout', 5000)};",
     ]
 
 
-def init_sqlite(configs: ConfigParser) -> sqlite3.Connection:
+def ensure_sqlite_path(configs: ConfigParser):
     sqlite_path = configs['sqlite']['path']
-    pragmed = sqlite_pragmas()
     logger.info(f"Using SQLite database at: {sqlite_path}")
     if os.path.exists(sqlite_path):
         logger.info(f"SQLite database file found at: {sqlite_path}")
@@ -101,33 +113,74 @@ def init_sqlite(configs: ConfigParser) -> sqlite3.Connection:
             logger.info(
                 f"Created directory for SQLite database: {os.path.dirname(sqlite_path)}")
 
-    conn = sqlite3.connect(sqlite_path)
-    cursor = conn.cursor()
-    for pragma in pragmed:
-        cursor.execute(pragma)
-    return conn
 
+def init_db_executor(configs: ConfigParser) -> ThreadPoolExecutor:
+    workers = configs['sqlite'].getint('workers', 4)
+    logger.info(f"Using {workers} threads for database calls")
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sqlite")
 
-def init_sqlalchemy(configs: ConfigParser) -> Engine:
+
+def init_sqlalchemy(configs: ConfigParser, pool_size: int) -> Engine:
     sqlite_path = configs['sqlite']['path']
     engine = create_engine(
-        f'sqlite:///{sqlite_path}', connect_args={"check_same_thread": False})
-    logger.info(f"SQLAlchemy engine created for SQLite at: {sqlite_path}")
+        f'sqlite:///{sqlite_path}',
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=0,
+        pool_timeout=configs['sqlite'].getint('busyTimeout', 5000) / 1000)
+    logger.info(
+        f"SQLAlchemy engine created for SQLite at: {sqlite_path} with {pool_size} connections")
 
     # Set SQLite PRAGMAs on connect
+    pragmas = sqlite_pragmas(configs)
+
     @event.listens_for(engine, "connect")
     def set_sqlite_pragmas(dbapi_connection, connection_record):
         cursor = dbapi_connection.cursor()
-        for pragma in sqlite_pragmas():
+        for pragma in pragmas:
             cursor.execute(pragma)
         cursor.close()
 
     return engine
 
 
+class RoutingSession(Session):
+    """
+    Session that sends writes to a single-connection writer engine and reads
+    to a pool of reader connections. With WAL, readers never wait on the
+    writer, and writers queue on the writer pool instead of failing with
+    `database is locked`. Once a transaction has written, the rest of it
+    stays on the writer so it can read its own changes.
+    """
+
+    def __init__(self, reader: Engine, writer: Engine, **kwargs):
+        super().__init__(**kwargs)
+        self.reader = reader
+        self.writer = writer
+        self.writing = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.writing or self._flushing or isinstance(clause, UpdateBase):
+            self.writing = True
+            return self.writer
+        return self.reader
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _reset_routing(session: RoutingSession, transaction):
+    if transaction.parent is None:
+        session.writing = False
+
+
+def init_session_factory(reader: Engine, writer: Engine) -> sessionmaker:
+    return sessionmaker(class_=RoutingSession, reader=reader, writer=writer, expire_on_commit=False)
+
+
 class MemZeroConfigurer:
-    def __init__(self, configs: ConfigParser):
+    def __init__(self, configs: ConfigParser, embeddings: Embeddings):
         self.configs = configs
+        self.embeddings = embeddings
 
     def get_memory(self) -> AsyncMemory:
         mc = self._get_configs()
@@ -163,21 +216,17 @@ class MemZeroConfigurer:
         }
 
     def _get_embeddings(self) -> dict[str, any]:
+        # Share the registry embeddings (and their cache) with mem0
         return {
-            "provider": "openai",
+            "provider": "langchain",
             "config": {
-                "model": self.configs['embeddings']['name'],
-                "api_key": self.configs['embeddings']['token'],
-                "openai_base_url": self.configs['embeddings']['baseUrl'],
+                "model": self.embeddings,
             }
         }
 
 
-m0c = MemZeroConfigurer(read_config())
-
-
-def init_memory(configs: ConfigParser) -> AsyncMemory:
-    return m0c.get_memory()
+def init_memory(configs: ConfigParser, embeddings: Embeddings) -> AsyncMemory:
+    return MemZeroConfigurer(configs, embeddings).get_memory()
 
 
 class Registry:
@@ -190,9 +239,17 @@ class Registry:
         self.voice = init_whisper_model(configs)
         self.note_vector_by_collection = {}
         self.task_vector_by_collection = {}
-        self.sqlite = init_sqlite(configs)
-        self.alchemy = init_sqlalchemy(configs)
-        self.memory = init_memory(configs)
+        ensure_sqlite_path(configs)
+        self.alchemy = init_sqlalchemy(configs, pool_size=1)
+        self.alchemy_readers = init_sqlalchemy(
+            configs, pool_size=configs['sqlite'].getint('readers', 4))
+        auditor = QueryPlanAuditor(configs['sqlite'].get('auditQueries', 'off'))
+        auditor.attach(self.alchemy)
+        auditor.attach(self.alchemy_readers)
+        self.session_factory = init_session_factory(
+            reader=self.alchemy_readers, writer=self.alchemy)
+        self.db_executor = init_db_executor(configs)
+        self.memory = init_memory(configs, self.embeddings)
         logger.info("Registry initialized with all services")
         self.configs = configs
 
@@ -205,13 +262,13 @@ class Registry:
     def get_new_chat(self, tools: list[any] = []) -> ChatOpenAI:
         return init_chat_model(self.configs, tools)
 
-    def get_voice(self) -> Model:
+    def get_voice(self) -> TranscriptionEngine:
         return self.voice
 
     def get_configs(self) -> ConfigParser:
         return self.configs
 
-    def get_embeddings(self) -> OpenAIEmbeddings:
+    def get_embeddings(self) -> CachedEmbeddings:
         return self.embeddings
 
     def get_notes_vector_db(self, collection: str) -> Chroma:
@@ -247,15 +304,16 @@ class Registry:
     def get_memory(self) -> AsyncMemory:
         return self.memory
 
-    def get_sqlite(self) -> sqlite3.Connection:
-        return self.sqlite
-
     def get_alchemy(self):
         return self.alchemy
 
     def get_session(self) -> Session:
-        Session = sessionmaker(bind=self.alchemy, expire_on_commit=False)
-        return Session()
+        return self.session_factory()
+
+    async def run_db(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        """Run blocking database work on the database thread pool, off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, functools.partial(fn, *args, **kwargs))
 
     def get_webrtc_vad(self):
         return webrtcvad.Vad(1)
@@ -266,8 +324,11 @@ class Registry:
             llm=self.model)
 
     def close(self):
-        self.sqlite.close()
+        self.voice.close()
+        self.db_executor.shutdown(wait=True)
         self.alchemy.dispose()
+        self.alchemy_readers.dispose()
+        self.embeddings.close()
 
 
 registry = Registry()
@@ -0,0 +1,61 @@
+"""
+Tests run against a throwaway SQLite database built from the models and
+migrations. `setup` builds the full registry (chat models, mem0, Whisper)
+when imported, so it is replaced by a registry holding only the database
+before any service module is imported.
+"""
+import asyncio
+import os
+import sys
+import types
+from configparser import ConfigParser
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class DatabaseRegistry:
+    """The database part of `setup.Registry`."""
+
+    def __init__(self, path: str):
+        self.configs = ConfigParser()
+        self.configs['sqlite'] = {'path': path}
+        self.alchemy = create_engine(f"sqlite:///{path}")
+        self.session_factory = sessionmaker(bind=self.alchemy, expire_on_commit=False)
+
+    def get_configs(self) -> ConfigParser:
+        return self.configs
+
+    def get_alchemy(self):
+        return self.alchemy
+
+    def get_session(self):
+        return self.session_factory()
+
+    async def run_db(self, fn, *args, **kwargs):
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+
+if "setup" not in sys.modules:
+    setup = types.ModuleType("setup")
+    setup.Registry = DatabaseRegistry
+    setup.registry = None
+    sys.modules["setup"] = setup
+
+
+@pytest.fixture
+def registry(tmp_path) -> DatabaseRegistry:
+    from services.migrations import MigrationRunner
+    from services.models import init_models
+
+    registry = DatabaseRegistry(str(tmp_path / "data.db"))
+    init_models(registry.alchemy)
+    runner = MigrationRunner(registry.alchemy)
+    runner.run()
+    # Background migrations too, the schema must be the final one
+    for migration in runner.pending():
+        runner._apply(migration)
+    yield registry
+    registry.alchemy.dispose()
@@ -0,0 +1,74 @@
+import asyncio
+import threading
+import pytest
+
+pytest.importorskip("langchain_core")
+from langchain_core.embeddings import Embeddings
+from embed_cache import CachedEmbeddings, EmbeddingStore
+
+
+class SlowEmbeddings(Embeddings):
+    """Returns the length of each text once `release` is set."""
+
+    def __init__(self):
+        self.release = asyncio.Event()
+        self.calls = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.calls += 1
+        return [[float(len(t))] for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        await self.release.wait()
+        return self.embed_documents(texts)
+
+
+class ThreadRecordingStore(EmbeddingStore):
+    def __init__(self, path: str):
+        super().__init__(path, max_bytes=1 << 20)
+        self.threads = set()
+
+    def get_many(self, keys):
+        self.threads.add(threading.current_thread())
+        return super().get_many(keys)
+
+    def put_many(self, vectors):
+        self.threads.add(threading.current_thread())
+        super().put_many(vectors)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = CachedEmbeddings(
+        SlowEmbeddings(), "test", ThreadRecordingStore(str(tmp_path / "embeddings.db")), memory_items=16)
+    yield cache
+    cache.close()
+
+
+def test_cancelled_waiter_does_not_cancel_owner(cache):
+    async def run():
+        owner = asyncio.create_task(cache.aembed_documents(["a", "bb"]))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(cache.aembed_documents(["a"]), 0.01)
+
+        cache.embeddings.release.set()
+        assert await owner == [[1.0], [2.0]]
+        assert cache._inflight == {}
+        assert await asyncio.wait_for(cache.aembed_documents(["bb", "ccc"]), 1) == [[2.0], [3.0]]
+
+    asyncio.run(run())
+
+
+def test_async_store_access_is_off_the_loop(cache):
+    async def run():
+        cache.embeddings.release.set()
+        await cache.aembed_documents(["a"])
+        return threading.current_thread()
+
+    loop_thread = asyncio.run(run())
+    assert len(cache.store.threads) > 0
+    assert loop_thread not in cache.store.threads
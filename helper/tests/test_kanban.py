@@ -0,0 +1,24 @@
+import pytest
+from services.changes import change_feed
+
+
+@pytest.fixture
+def kanban(registry):
+    from services.kanban import CreateKanbanRequest, KanbanService
+
+    service = KanbanService(registry)
+    for i in range(3):
+        service.create(CreateKanbanRequest(
+            title=f"Task {i}", description=f"Description {i}", board="to_do", due_date=None, priority=1))
+    change_feed.drain()
+    return service
+
+
+def test_move_publishes_the_task(kanban):
+    from services.kanban import MoveKanbanRequest
+
+    task = kanban.list_by_board(board="to_do")["to_do"].tasks[0]
+    kanban.move(MoveKanbanRequest(task_id=task.id, board="in_progress"))
+
+    assert change_feed.drain().tasks == {task.id}
+    assert kanban.get(task.id).is_dirty
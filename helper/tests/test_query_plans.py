@@ -0,0 +1,118 @@
+"""
+Every service query runs under QueryPlanAuditor("raise"), so a query that
+needs a full table scan or a temporary sort for its ORDER BY fails here
+instead of on a large database.
+"""
+from datetime import datetime, timedelta
+import pytest
+from services.query_plan import QueryPlanAuditor, QueryPlanError
+from sqlalchemy import text
+
+
+@pytest.fixture
+def audited(registry):
+    QueryPlanAuditor("raise").attach(registry.alchemy)
+    return registry
+
+
+@pytest.fixture
+def kanban(audited):
+    from services.kanban import CreateKanbanRequest, KanbanService
+
+    service = KanbanService(audited)
+    for i in range(6):
+        service.create(CreateKanbanRequest(
+            title=f"Task {i}",
+            description=f"Description {i}",
+            board="to_do" if i % 2 == 0 else "in_progress",
+            due_date=datetime.now() + timedelta(days=i),
+            priority=1 + i % 4))
+    return service
+
+
+@pytest.fixture
+def notes(audited):
+    from services.notes import CreateNoteRequest, NotesService
+
+    service = NotesService(audited)
+    for i in range(3):
+        service.create(CreateNoteRequest(title=f"Note {i}", content=f"Content {i}"))
+    return service
+
+
+def test_auditor_rejects_full_scan(audited):
+    with audited.alchemy.connect() as conn:
+        with pytest.raises(QueryPlanError):
+            conn.execute(text("SELECT * FROM tasks WHERE description = 'x'"))
+
+
+def test_kanban_queries(kanban):
+    from services.kanban import MoveKanbanRequest
+
+    pages = kanban.list_by_board(limit=2)
+    todo = pages["to_do"]
+    assert len(todo.tasks) == 2
+    assert todo.next_cursor is not None
+
+    page = kanban.list_by_board(limit=2, board="to_do", cursor=todo.next_cursor)["to_do"]
+    assert [t.id for t in page.tasks] != [t.id for t in todo.tasks]
+
+    first, second = todo.tasks
+    task = kanban.get(page.tasks[0].id)
+    kanban.move(MoveKanbanRequest(
+        task_id=task.id, board="to_do", before_task_id=first.id, after_task_id=second.id))
+    kanban.move(MoveKanbanRequest(task_id=task.id, board="done", before_task_id=None))
+    kanban.move(MoveKanbanRequest(task_id=task.id, board="to_do", after_task_id=first.id))
+
+    kanban.list_by_duedate_within(3)
+    kanban.list_by_duedate_today()
+    kanban.list_by_duedate_tomorrow()
+    kanban.list_by_duedate_this_week()
+    kanban.list_by_duedate_this_month()
+
+    kanban.delete(task.id)
+    with pytest.raises(ValueError):
+        kanban.get(task.id)
+
+
+def test_notes_queries(notes):
+    from services.notes import UpdateNoteRequest
+
+    listed = notes.list()
+    assert len(listed) == 3
+
+    note = notes.get(listed[0].id)
+    notes.update(note.id, UpdateNoteRequest(title="Renamed", content="New content"))
+    notes.delete(note.id)
+    assert len(notes.list()) == 2
+
+
+def test_config_queries(audited):
+    from services.config import ConfigKey, ConfigService
+
+    service = ConfigService(audited)
+    service.list()
+    with audited.get_session() as session:
+        assert service._get(session, ConfigKey.DEFAULT_AUDIO_DEVICE_NAME) is None
+
+
+def test_lexical_queries(audited, kanban, notes):
+    pytest.importorskip("langchain_core")
+    from services.changes import DocumentKind
+    from services.lexical import LexicalIndex
+    from services.models import Note, Task
+
+    index = LexicalIndex(audited)
+    with audited.get_session() as session:
+        index.upsert_notes(session, session.query(Note).all())
+        index.upsert_tasks(session, session.query(Task).all())
+        session.commit()
+
+    assert len(index.search(DocumentKind.NOTE, "Content", 5)) > 0
+    assert len(index.search(DocumentKind.TASK, "#1", 5)) > 0
+
+
+@pytest.mark.parametrize("limit", [0, -1])
+def test_kanban_rejects_empty_pages(kanban, limit):
+    with pytest.raises(ValueError):
+        kanban.list_by_board(limit=limit)
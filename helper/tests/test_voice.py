@@ -0,0 +1,85 @@
+import asyncio
+import pytest
+
+pytest.importorskip("pywhispercpp")
+pytest.importorskip("sounddevice")
+from services.voice import VoiceService
+
+
+class FinishingRecorder:
+    """Commits the utterance in progress on stop, like AudioRecorder."""
+
+    def __init__(self, on_data, on_partial):
+        self.on_data = on_data
+        self.on_partial = on_partial
+
+    def stop(self):
+        self.on_data("four")
+        self.on_partial("")
+
+
+class Session:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_stop_delivers_the_last_utterance():
+    service = VoiceService(None, None)
+    sent = []
+
+    async def send(text: str):
+        # A websocket send yields to the loop
+        await asyncio.sleep(0.01)
+        sent.append(text)
+
+    async def on_error(e: Exception):
+        raise e
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        recorder = FinishingRecorder(
+            service.sync_on_data(loop, queue), service.sync_on_partial(loop, queue))
+        session = Session()
+        task = asyncio.create_task(service.consume_queue(queue, send, on_error, send))
+
+        await service.canceler(recorder, session, queue, task)()
+        assert session.closed
+        assert task.done()
+
+    asyncio.run(run())
+    assert sent == ["four", ""]
+
+
+def test_transcribe_reads_a_chunked_body(monkeypatch):
+    pytest.importorskip("sse_starlette")
+    httpx = pytest.importorskip("httpx")
+    from fastapi import FastAPI
+    import voice
+    from services.voice import TranscribeResponse
+
+    async def count_bytes(source, name):
+        total = 0
+        async for data in source:
+            total += len(data)
+        yield TranscribeResponse(code=200, content=str(total))
+
+    monkeypatch.setattr(voice.service, "transcribe", count_bytes)
+    app = FastAPI()
+    app.include_router(voice.router)
+
+    async def body():
+        for _ in range(200):
+            yield b"\0" * 1000
+            await asyncio.sleep(0)
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.wait_for(client.post("/voice/transcribe", content=body()), 5)
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    assert "content='200000'" in response.text
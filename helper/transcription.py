@@ -0,0 +1,175 @@
+from collections import deque
+from concurrent.futures import Future
+from configparser import ConfigParser
+import logging
+import os
+import threading
+import numpy as np
+from pywhispercpp.model import Model, Segment
+
+logger = logging.getLogger(__name__)
+
+
+class TranscriptionBusy(Exception):
+    """Raised when no transcription session can be admitted."""
+
+
+class TranscriptionSession:
+    """
+    A client of the engine, a live recording or an uploaded file.
+
+    Jobs of one session may be decoded by several contexts at once, callers
+    that need results in order keep their futures in order.
+    """
+
+    def __init__(self, engine: 'TranscriptionEngine', name: str):
+        self.engine = engine
+        self.name = name
+        self.jobs: deque[tuple[Future, np.ndarray, dict]] = deque()
+        self.closed = False
+
+    def submit(self, media: np.ndarray, **params) -> Future:
+        """Queue `media` for decoding; the future resolves to its segments."""
+        return self.engine._submit(self, media, params)
+
+    def transcribe(self, media: np.ndarray, **params) -> list[Segment]:
+        return self.submit(media, **params).result()
+
+    def close(self):
+        self.engine._close_session(self)
+
+    def __repr__(self):
+        return f"TranscriptionSession({self.name})"
+
+
+class TranscriptionEngine:
+    """
+    Pool of Whisper model contexts shared by all transcription sessions.
+
+    A whisper.cpp context decodes one input at a time, so each context is
+    served by its own thread. Sessions keep their own job queues and the
+    contexts take jobs from the sessions with pending work in turn, so a
+    long file doesn't starve live dictation.
+
+    At most `max_sessions` sessions are open at once. Past that,
+    `open_session` fails with `TranscriptionBusy` or, with `overload` set
+    to "queue", waits up to `queue_timeout` seconds for a session to close.
+    """
+
+    def __init__(self, model: str, models_dir: str, contexts: int, threads: int,
+                 max_sessions: int, overload: str, queue_timeout: float):
+        if overload not in ("reject", "queue"):
+            raise ValueError(f"Unknown voice overload policy: {overload}")
+
+        self.contexts = contexts
+        self.threads = threads
+        self.max_sessions = max_sessions
+        self.overload = overload
+        self.queue_timeout = queue_timeout
+        self.sessions: list[TranscriptionSession] = []
+        self.ready: deque[TranscriptionSession] = deque()
+        self.closing = False
+        self._lock = threading.Condition()
+        self._slots = threading.Semaphore(max_sessions)
+
+        logger.info(
+            f"Loading Whisper model {model} in {contexts} contexts of {threads} threads")
+        self.models = [Model(model=model, models_dir=models_dir, n_threads=threads)
+                       for _ in range(contexts)]
+        self.workers = [threading.Thread(target=self._run, args=(m,), name=f"Whisper-{i}", daemon=True)
+                        for i, m in enumerate(self.models)]
+        for worker in self.workers:
+            worker.start()
+
+    def open_session(self, name: str) -> TranscriptionSession:
+        wait = self.overload == "queue"
+        if not self._slots.acquire(blocking=wait, timeout=self.queue_timeout if wait else None):
+            raise TranscriptionBusy(
+                f"All {self.max_sessions} transcription sessions are in use")
+
+        session = TranscriptionSession(self, name)
+        with self._lock:
+            self.sessions.append(session)
+        logger.debug(f"Opened {session}, {len(self.sessions)} sessions")
+        return session
+
+    def close(self):
+        with self._lock:
+            self.closing = True
+            for session in self.sessions:
+                self._cancel_jobs(session)
+            self._lock.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def _submit(self, session: TranscriptionSession, media: np.ndarray, params: dict) -> Future:
+        future = Future()
+        with self._lock:
+            if session.closed or self.closing:
+                raise RuntimeError(f"{session} is closed")
+            session.jobs.append((future, media, params))
+            if len(session.jobs) == 1:
+                self.ready.append(session)
+                self._lock.notify()
+        return future
+
+    def _close_session(self, session: TranscriptionSession):
+        with self._lock:
+            if session.closed:
+                return
+            session.closed = True
+            self._cancel_jobs(session)
+            self.sessions.remove(session)
+        self._slots.release()
+        logger.debug(f"Closed {session}")
+
+    def _cancel_jobs(self, session: TranscriptionSession):
+        while len(session.jobs) > 0:
+            session.jobs.popleft()[0].cancel()
+        if session in self.ready:
+            self.ready.remove(session)
+
+    def _next_job(self) -> tuple[Future, np.ndarray, dict]:
+        with self._lock:
+            while len(self.ready) == 0 and not self.closing:
+                self._lock.wait()
+            if self.closing:
+                return None
+
+            # Round robin, a session with more work goes to the back of the line
+            session = self.ready.popleft()
+            job = session.jobs.popleft()
+            if len(session.jobs) > 0:
+                self.ready.append(session)
+            return job
+
+    def _run(self, model: Model):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+            future, media, params = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(model.transcribe(media=media, **params))
+            except Exception as e:
+                logger.error(f"Transcription failed: {e}")
+                future.set_exception(e)
+
+    @staticmethod
+    def from_config(configs: ConfigParser) -> 'TranscriptionEngine':
+        voice = configs['voice']
+        cores = os.cpu_count() or 1
+        # whisper.cpp scales poorly past a few threads per context, more
+        # contexts serve more sessions at once
+        contexts = voice.getint('contexts', 0) or max(1, cores // 4)
+        threads = voice.getint('threads', 0) or max(1, cores // contexts)
+        return TranscriptionEngine(
+            model=voice['name'],
+            models_dir=voice['directory'],
+            contexts=contexts,
+            threads=threads,
+            max_sessions=voice.getint('maxSessions', 0) or 2 * contexts,
+            overload=voice.get('overload', 'reject'),
+            queue_timeout=voice.getfloat('queueTimeout', 30))
@@ -1,12 +1,20 @@
-from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+import tempfile
+from typing import AsyncIterator
+from fastapi import APIRouter, HTTPException, Request, UploadFile, WebSocket, WebSocketDisconnect
 from pydantic import BaseModel
-from services.voice import VoiceService
+from sse_starlette import EventSourceResponse
+from services.voice import TranscribeResponse, VoiceService
 from setup import registry
 from services.config import config_service
+from transcription import TranscriptionBusy
 import logging
 
 logger = logging.getLogger(__name__)
 
+UPLOAD_CHUNK = 64 * 1024
+# Raw bodies are spooled to disk past this size, like multipart uploads
+SPOOL_SIZE = 1024 * 1024
+
 router = APIRouter(prefix="/voice")
 service = VoiceService(registry, config_service)
 
@@ -16,6 +24,61 @@ def getDevices():
     return service.list_devices()
 
 
+@router.post("/transcribe")
+async def transcribe(request: Request):
+    """
+    Transcribe an audio file sent as the request body, or as the `file`
+    field of a multipart form. The upload is received in full before the
+    response starts, segments are then streamed back as they are decoded.
+    """
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        # Starlette spools the upload to disk past 1 MB
+        form = await request.form()
+        upload = form.get("file")
+        if not isinstance(upload, UploadFile):
+            raise HTTPException(status_code=400, detail="Missing file field")
+        source, name = read_upload(upload), upload.filename or "upload"
+    else:
+        upload = await spool_body(request)
+        source, name = read_upload(upload), "body"
+
+    return EventSourceResponse(safe_generator(service.transcribe(source, name)))
+
+
+async def spool_body(request: Request) -> UploadFile:
+    # EventSourceResponse listens for the client disconnecting on the same
+    # connection and drops any body message it receives, so the body can't
+    # be read once the response has started
+    upload = UploadFile(file=tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE), filename="body")
+    try:
+        async for data in request.stream():
+            await upload.write(data)
+        await upload.seek(0)
+    except BaseException:
+        await upload.close()
+        raise
+    return upload
+
+
+async def read_upload(upload: UploadFile) -> AsyncIterator[bytes]:
+    try:
+        while data := await upload.read(UPLOAD_CHUNK):
+            yield data
+    finally:
+        await upload.close()
+
+
+async def safe_generator(gen):
+    try:
+        async for item in gen:
+            yield item
+    except ValueError as e:
+        yield TranscribeResponse(code=400, content=f"Error: {str(e)}")
+    except Exception as e:
+        logger.error(f"Error transcribing audio: {e}")
+        yield TranscribeResponse(code=500, content=f"Internal error: {str(e)}")
+
+
 class LiveTranscribeRequest(BaseModel):
     type: str
     deviceId: int | None = None
@@ -49,6 +112,16 @@ async def run_state(ws: WebSocket):
             await ws.close(code=1000, reason="Transcription stopped")
         return
 
+    async def on_partial(text: str):
+        try:
+            await ws.send_json(
+                LiveTranscribeResponse(
+                    type="vc_partial", data=text).model_dump(),
+                mode="text"
+            )
+        except WebSocketDisconnect:
+            logger.info("WebSocket disconnected during on_partial")
+
     async def on_error(e: Exception):
         logger.error(f"Error in live transcription: {e}")
         try:
@@ -66,9 +139,14 @@ async def run_state(ws: WebSocket):
                 logger.debug(f"Received request: {request}")
 
                 if is_start(request=request):
+                    if cancel_record:
+                        # One recording per socket, a new start replaces it
+                        logger.info("Restarting live transcription")
+                        await cancel_record()
+                        cancel_record = None
                     logger.info("Starting live transcription")
-                    cancel_record = service.start_record(
-                        device_id=request.deviceId or 0, on_data=on_data, on_error=on_error)
+                    cancel_record = await service.start_record(
+                        device_id=request.deviceId or 0, on_data=on_data, on_error=on_error, on_partial=on_partial)
                     await ws.send_json(
                         LiveTranscribeResponse(
                             type="vc_start_ok", data="Recording started").model_dump(),
@@ -83,6 +161,10 @@ async def run_state(ws: WebSocket):
             except WebSocketDisconnect:
                 logger.info("WebSocket disconnected")
                 break
+            except TranscriptionBusy as e:
+                logger.warning(e)
+                await ws.send_json(LiveTranscribeResponse(type="vc_stop", data=str(e)).model_dump())
+                break
             except Exception as e:
                 logger.error(e)
                 await ws.send_json(LiveTranscribeResponse(type="vc_stop").model_dump())